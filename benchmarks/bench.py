@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Time ovcli operations against the local fake OpenvCloud API.
+
+Every inventory size gets a fresh fake API and a throw-away HOME, so cache and
+token files never leak between runs::
+
+    python benchmarks/bench.py --sizes 10,1000,100000 --latency 0.02
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HOME = tempfile.mkdtemp(prefix='ovcli-bench-')
+os.environ['HOME'] = HOME
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ovcli.client import Client  # noqa: E402
+from ovcli.fakeapi import FakeAPI, Inventory  # noqa: E402
+
+ENVIRONMENT = 'bench.environments.local'
+CLOUDSPACES = 10
+
+
+def write_config(url):
+    os.makedirs(os.path.join(HOME, '.config'), exist_ok=True)
+    with open(os.path.join(HOME, '.config', 'ovc.cfg'), 'w') as fd:
+        fd.write('[environments]\n{} = {}\n\n'.format(ENVIRONMENT, url))
+        fd.write('[iyo]\nclientid = bench\nclientsecret = bench\nurl = {}/v1/oauth/access_token\n'.format(url))
+
+
+def make_client(cached=False):
+    cli = Client()
+    cli.cache.enabled = cached
+    cli.set_environment(ENVIRONMENT)
+    return cli
+
+
+def timeit(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def scenarios(size):
+    counter = iter(range(10 ** 9))
+    cli = make_client()
+    cloudspace = cli.list_cloudspaces()[0]
+    vms = cli.list_vms(cloudspace)
+    target = vms[len(vms) // 2]['name']
+    cached = make_client(cached=True)
+    cached.list_vms(cloudspace)
+
+    def shell_navigation():
+        from ovcli.shell import Shell
+        from prompt_toolkit.document import Document
+        shell = Shell(make_client())
+        shell.components[-1].update_components(ENVIRONMENT)
+        shell.components[-1].update_components('cloudspace')
+        shell.components[-1].update_components(cloudspace['name'])
+        shell.components[-1].update_components('vm')
+        list(shell.get_completions_async(Document(target[:-1]), None))
+        shell.components[-1].validate(Document(target))
+        shell.components[-1].update_components(target)
+        shell.prefetcher.stop()
+
+    def bulk_action():
+        targets = cli.match_vms([cloudspace], 'vm-*', ['RUNNING', 'HALTED'])[:20]
+        cli.bulk_vm_action('reboot', targets)
+
+    return [
+        ('list cloudspaces', cli.list_cloudspaces),
+        ('list vms', lambda: cli.list_vms(cloudspace)),
+        ('list vms (cached)', lambda: cached.list_vms(cloudspace)),
+        ('list forwards', lambda: cli.list_forwards(cloudspace)),
+        ('select vm', lambda: cli.select_vm(cloudspace, target)),
+        ('create vm', lambda: cli.create_machine(cloudspace, 'bench-{}'.format(next(counter)), 512, 1)),
+        ('bulk create 10 vms', lambda: cli.create_machines(
+            cloudspace, ['bulk-{}'.format(next(counter)) for _ in range(10)], 512, 1)),
+        ('bulk reboot 20 vms', bulk_action),
+        ('shell navigation', shell_navigation),
+    ]
+
+
+def run(sizes, repeat, latency, error_rate):
+    results = []
+    for size in sizes:
+        inventory = Inventory(vms=size, cloudspaces=min(CLOUDSPACES, size))
+        server = FakeAPI(inventory, latency=latency, error_rate=error_rate)
+        server.start()
+        write_config(server.url)
+        try:
+            for name, func in scenarios(size):
+                durations = timeit(func, repeat)
+                results.append({'scenario': name, 'vms': size, 'min': min(durations),
+                                'median': statistics.median(durations), 'max': max(durations)})
+                print('{:<22} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                    name, size, *(results[-1][key] * 1000 for key in ('min', 'median', 'max'))), file=sys.stderr)
+        finally:
+            server.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ovcli against a fake OpenvCloud API')
+    parser.add_argument('--sizes', default='10,1000,100000', help='Comma separated amounts of VMs')
+    parser.add_argument('--repeat', default=5, type=int, help='Runs per scenario')
+    parser.add_argument('--latency', default=0, type=float, help='Seconds the fake API delays every call')
+    parser.add_argument('--error-rate', default=0, type=float, help='Fraction of calls failing with a 503')
+    parser.add_argument('--json', default=None, help='Also write the results to this file')
+    options = parser.parse_args()
+    print('{:<22} {:>8} {:>10} {:>10} {:>10}'.format('scenario', 'vms', 'min ms', 'median ms', 'max ms'), file=sys.stderr)
+    results = run([int(size) for size in options.sizes.split(',')], options.repeat, options.latency, options.error_rate)
+    if options.json:
+        with open(options.json, 'w') as fd:
+            json.dump(results, fd, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Fail when the cold start of ``ovcli --help`` regresses.
+
+Runs ``python -X importtime -m ovcli --help`` a few times and checks that the
+median import time of the ovcli modules stays under a budget and that none of
+the heavy modules get imported before a command needs them::
+
+    python benchmarks/startup.py --budget-ms 30
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that should only be loaded once a command actually runs
+FORBIDDEN = ['requests', 'asyncio', 'yaml', 'prompt_toolkit', 'ovcli.client', 'concurrent.futures']
+
+
+def measure(args):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'ovcli'] + args, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = {}
+    total = 0
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        modules[name.strip()] = int(cumulative)
+        # top level imports have a single space of indentation
+        if name.startswith(' ') and not name.startswith('  ') and name.strip().startswith('ovcli'):
+            total += int(cumulative)
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time budget of ovcli --help')
+    parser.add_argument('--budget-ms', default=30, type=float, help='Maximum median import time of ovcli modules')
+    parser.add_argument('--runs', default=5, type=int, help='Amount of runs to take the median of')
+    options = parser.parse_args()
+    totals = []
+    imported = set()
+    for _ in range(options.runs):
+        total, modules = measure(['--help'])
+        totals.append(total)
+        imported.update(name for name in FORBIDDEN if name in modules)
+    median = statistics.median(totals) / 1000
+    print('ovcli --help imports: median {:.1f} ms, budget {:.1f} ms'.format(median, options.budget_ms))
+    failed = False
+    if imported:
+        print('Imported before needed: {}'.format(', '.join(sorted(imported))))
+        failed = True
+    if median > options.budget_ms:
+        print('Import time over budget')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,435 @@
 #!/usr/bin/env python3
-from .client import Client
+import re
+import sys
 from .parsers import parser
+from .utils import is_pattern, fanout, filter_items
+
+# Everything else is imported where it is needed, so --help and argument
+# errors do not pay for requests, asyncio and the client
+
+
+def make_client(options, tokens=None, transport=None):
+    from .client import Client
+    cli = Client(tokens, transport)
+    cli.cache.enabled = not options.no_cache
+    cli.cache.refresh = options.refresh
+    cli.match_mode = options.match_mode
+    cli.output = options.output
+    cli.fields = options.fields.split(',') if options.fields else None
+    return cli
+
+
+def is_list_command(options):
+    action = {'vm': 'vmaction', 'cloudspace': 'csaction', 'forwarding': 'fwdaction'}.get(options.group)
+    return action is not None and getattr(options, action) == 'list'
+
+
+def list_environment(environment, options, tokens, transport):
+    cli = make_client(options, tokens, transport)
+    cli.set_environment(environment)
+    cloudspaces = cli.list_cloudspaces()
+    if options.group == 'cloudspace':
+        return cloudspaces
+    if options.cloudspace:
+        names = set(filter_items([cs['name'] for cs in cloudspaces], options.cloudspace, options.match_mode))
+        cloudspaces = [cs for cs in cloudspaces if cs['name'] in names]
+    lister = cli.list_vms if options.group == 'vm' else cli.list_forwards
+    results = []
+    for cloudspace, items, error in fanout(lister, cloudspaces, options.workers):
+        if error is not None:
+            raise error
+        results.append((cloudspace, items))
+    return results
+
+
+def list_environments(options):
+    from .output import get_writer
+    cli = make_client(options)
+    environments = cli.match_environments(options.env)
+    if not environments:
+        raise LookupError('Could not find environment with filter {}'.format(options.env))
+    cli.tokens.prefetch(environments, options.workers)
+    results = fanout(lambda env: list_environment(env, options, cli.tokens, cli.transport), environments, options.workers)
+    kind = {'vm': 'vm', 'cloudspace': 'cloudspace', 'forwarding': 'forward'}[options.group]
+    writer = get_writer(kind, cli.output, cli.fields)
+    failed = []
+    for environment, result, error in results:
+        name = environment.split('.')[-1]
+        if error is not None:
+            print('{}: {}'.format(name, error), file=sys.stderr)
+            failed.append(name)
+        elif options.group == 'cloudspace':
+            cli.print_cloudspaces(result, environment=name, writer=writer)
+        else:
+            printer = cli.print_vms if options.group == 'vm' else cli.print_forwards
+            for cloudspace, items in result:
+                printer(cloudspace, items, environment=name, writer=writer)
+    writer.close()
+    if failed:
+        sys.exit('Failed: {}'.format(', '.join(failed)))
+
+
+def watch_list(cli, options, cloudspace=None):
+    from .watch import Watcher, ndjson_emitter, text_emitter
+    # every poll should hit the API, the cache only keeps other commands warm
+    cli.cache.refresh = True
+    if options.group == 'vm':
+        fetch, key, line = lambda: cli.list_vms(cloudspace), lambda vm: vm['id'], '{name} {status}'
+    elif options.group == 'cloudspace':
+        fetch, key, line = cli.list_cloudspaces, lambda cs: cs['id'], '{name} {status} {externalnetworkip}'
+    else:
+        fetch = lambda: cli.list_forwards(cloudspace)
+        key = lambda fwd: '{publicIp}:{publicPort}'.format(**fwd)
+        line = '{machineName} {publicIp}:{publicPort} -> {localIp}:{localPort} {protocol}'
+    if options.events:
+        emit = ndjson_emitter(cli.environment, options.group)
+    else:
+        emit = text_emitter(lambda record: line.format(**record))
+    Watcher(fetch, key, options.interval, options.max_interval).run(emit)
+
+
+def bulk_vm_action(cli, options):
+    from .client import ACTION_STATES
+    if options.all_cloudspaces:
+        cloudspaces = cli.list_cloudspaces()
+    else:
+        cloudspaces = [cli.select_cloudspace(options.cloudspace)]
+    statuses = [status.upper() for status in options.status]
+    # act on the current statuses, not on a listing cached by an earlier command
+    targets = cli.match_vms(cloudspaces, options.match, statuses, cached=False)
+    if options.dry_run or not targets:
+        for cloudspace, vm in targets:
+            print('{} {} {}'.format(cloudspace['name'], vm['name'], vm['status']))
+        print('{} VMs selected'.format(len(targets)))
+        return
+    if options.action == 'delete' and not options.yes:
+        if input('Delete {} VMs? [y/N] '.format(len(targets))).lower() not in ['y', 'yes']:
+            return
+    results = cli.bulk_vm_action(options.action, targets, options.parallel, options.rate)
+    failed = [target for target, _, error in results if error is not None]
+    if options.wait:
+        done = [dict(vm, cloudspaceId=cs['id']) for (cs, vm), _, error in results if error is None]
+        try:
+            cli.wait_for_state(done, ACTION_STATES[options.action], options.timeout)
+        except TimeoutError as error:
+            print(error)
+    print('{} succeeded, {} failed'.format(len(targets) - len(failed), len(failed)))
+    if failed:
+        sys.exit('Failed: {}'.format(', '.join(vm['name'] for _, vm in failed)))
+
+
+def wait_for_vms(cli, vms, state, timeout):
+    """Wait for vms to reach a status, prints the vms still pending and returns False on timeout."""
+    try:
+        cli.wait_for_state(vms, state, timeout)
+    except TimeoutError as error:
+        print(error, file=sys.stderr)
+        return False
+    return True
+
+
+def sync_environment(environment, options, tokens, transport):
+    import asyncio
+    from .inventory import crawl
+    cli = make_client(options, tokens, transport)
+    # a sync should see the current state, the fresh responses still refresh the cache
+    cli.cache.refresh = True
+    cli.set_environment(environment)
+    return asyncio.run(crawl(cli))
+
+
+def inventory_environments(cli, options):
+    match = options.env or 'all'
+    if is_pattern(match, options.match_mode):
+        environments = cli.match_environments(match)
+    else:
+        environments = filter_items(cli.environments, match, options.match_mode)
+    if not environments:
+        raise LookupError('Could not find environment with filter {}'.format(options.env))
+    return environments
+
+
+def inventory_sync(options, cli=None, environments=None, fd=sys.stdout):
+    """Sync environments into the inventory, returns the names of the environments that failed."""
+    from .inventory import InventoryStore
+    cli = cli or make_client(options)
+    environments = environments or inventory_environments(cli, options)
+    cli.tokens.prefetch(environments, options.workers)
+    store = InventoryStore()
+    failed = []
+    results = fanout(lambda env: sync_environment(env, options, cli.tokens, cli.transport), environments, options.workers)
+    for environment, records, error in results:
+        name = environment.split('.')[-1]
+        if error is not None:
+            print('{}: {}'.format(name, error), file=sys.stderr)
+            failed.append(name)
+            continue
+        changes = store.sync(environment, records)
+        print('{}: {}'.format(name, ', '.join('{} {} changed {} removed'.format(table, *counts)
+                                               for table, counts in changes.items())), file=fd)
+    store.close()
+    return failed
+
+
+def find(options):
+    import time
+    from .inventory import InventoryStore
+    from .lookup import DEFAULT_MAX_AGE, LookupIndex
+    from .output import get_writer
+    cli = make_client(options)
+    maxage = options.max_age
+    if maxage is None:
+        maxage = float(cli.config['inventory'].get('max_age', DEFAULT_MAX_AGE)) if cli.config.has_section('inventory') else DEFAULT_MAX_AGE
+    environments = inventory_environments(cli, options)
+    store = InventoryStore()
+    syncs = store.syncs()
+    stale = [env for env in environments if syncs.get(env, 0) < time.time() - maxage * 60]
+    if stale:
+        failed = inventory_sync(options, cli, stale, sys.stderr)
+        if failed:
+            print('Could not refresh {}, answering from the last sync'.format(', '.join(failed)), file=sys.stderr)
+    index = LookupIndex.load(store)
+    store.close()
+    writer = get_writer('match', cli.output, cli.fields)
+    for entry in index.find(options.query, options.match_mode):
+        if entry['environment'] in environments:
+            writer.write(dict(entry, environment=entry['environment'].split('.')[-1]))
+    writer.close()
+    if not writer.count:
+        sys.exit('Nothing found for {}'.format(options.query))
+
+
+def inventory_query(options):
+    from .inventory import TABLES, InventoryStore, table_query
+    from .output import get_writer
+    sql = options.sql
+    if sql in TABLES:
+        sql = table_query(sql, options.where)
+    elif options.where:
+        parser.error('--where needs a table instead of a query')
+    store = InventoryStore(readonly=True)
+    columns, rows = store.query(sql)
+    store.close()
+    fields = options.fields.split(',') if options.fields else columns
+    writer = get_writer('row', options.output, fields)
+    for row in rows:
+        writer.write(row)
+    writer.close()
+
+
+def apply_stack(options):
+    from .stack import StackPlanner, load_stack, run_graph
+    stack = load_stack(options.file)
+    cli = make_client(options)
+    cli.select_environment(options.env or stack['environment'])
+    changes = StackPlanner(cli, stack, getattr(options, 'parallel', 8)).plan()
+    for change in changes:
+        print(change)
+    if not changes:
+        print('No changes')
+        return
+    deletes = len([change for change in changes if change.action == 'delete'])
+    print('{} to create, {} to update, {} to delete'.format(
+        len(changes) - deletes - len([change for change in changes if change.action == 'update']),
+        len([change for change in changes if change.action == 'update']), deletes))
+    if options.group == 'plan':
+        return
+    if deletes and not options.yes:
+        if input('Apply {} changes including {} deletes? [y/N] '.format(len(changes), deletes)).lower() not in ['y', 'yes']:
+            return
+
+    def report(change, error):
+        if error is None:
+            print('{} done'.format(change))
+        else:
+            print('{} failed: {}'.format(change, error), file=sys.stderr)
+
+    results = run_graph(changes, options.parallel, report)
+    failed = [key for key, error in results.items() if error is not None]
+    print('{} applied, {} failed'.format(len(results) - len(failed), len(failed)))
+    if failed:
+        sys.exit(1)
+
+
+def zaccess_exec(cli, options):
+    import json
+    import threading
+    nodes = cli.match_nodes(options.node)
+    if not nodes:
+        raise LookupError('Could not find node with filter {}'.format(options.node))
+    width = max(len(node['name']) for node in nodes)
+    lock = threading.Lock()
+    quiet = options.json == '-'
+
+    def emit(node, stream, line):
+        if quiet:
+            return
+        with lock:
+            print('{} | {}'.format(node.ljust(width), line), file=sys.stderr if stream == 'stderr' else sys.stdout, flush=True)
+
+    results = cli.exec_nodes(nodes, options.command, options.parallel, options.timeout, emit)
+    if options.json:
+        if quiet:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+        else:
+            with open(options.json, 'w') as fd:
+                json.dump(results, fd, indent=2)
+    failed = [name for name, result in results.items() if result['exitcode'] != 0]
+    summary = sys.stderr if quiet else sys.stdout
+    for name, result in results.items():
+        if result.get('error'):
+            status = 'error: {}'.format(result['error'])
+        elif result['timeout']:
+            status = 'timeout after {:.1f}s'.format(result['duration'])
+        else:
+            status = 'exit {} in {:.1f}s'.format(result['exitcode'], result['duration'])
+        print('{} {}'.format(name.ljust(width), status), file=summary)
+    print('{} succeeded, {} failed'.format(len(results) - len(failed), len(failed)), file=summary)
+    if failed:
+        sys.exit(1)
+
+
+def agent_command(options):
+    from . import agent
+    if options.agentaction == 'run':
+        agent.Agent().serve()
+        return
+    if options.agentaction == 'start':
+        status = agent.start()
+    elif options.agentaction == 'stop':
+        print('Agent stopped' if agent.stop() else 'No agent running')
+        return
+    else:
+        status = agent.running()
+    if not status:
+        sys.exit('No agent running')
+    print('Agent {pid} up {uptime:.0f}s, {requests} requests, environments: {}'.format(
+        ', '.join(env.split('.')[-1] for env in status['environments']) or '-', **status))
+
 
 def main():
     options = parser.parse_args()
+    if not options.no_agent:
+        from .agent import forwardable, forward
+        if forwardable(options):
+            code = forward(sys.argv[1:])
+            if code is not None:
+                sys.exit(code)
+    if options.profile or options.trace_file:
+        import atexit
+        from . import instrument
+    if options.profile:
+        profiler = instrument.Profiler()
+        instrument.add_hook(profiler)
+        atexit.register(profiler.report)
+    if options.trace_file:
+        tracer = instrument.TraceWriter(options.trace_file)
+        instrument.add_hook(tracer)
+        atexit.register(tracer.close)
     try:
-        cli = Client()
+        if options.group == 'agent':
+            agent_command(options)
+            return
+        elif options.group == 'inventory':
+            if options.inventoryaction != 'sync':
+                parser.error('inventory needs an action: sync')
+            failed = inventory_sync(options)
+            if failed:
+                sys.exit('Failed: {}'.format(', '.join(failed)))
+            return
+        elif options.group == 'query':
+            inventory_query(options)
+            return
+        elif options.group == 'find':
+            find(options)
+            return
+        elif options.group in ['apply', 'plan']:
+            apply_stack(options)
+            return
+        if options.env and is_pattern(options.env, options.match_mode):
+            if not is_list_command(options):
+                parser.error('--env {} is only supported for list commands'.format(options.env))
+            if options.watch:
+                parser.error('--watch needs a single environment')
+            list_environments(options)
+            return
+        cli = make_client(options)
         cli.select_environment(options.env)
-        if options.group in [None, 'zaccess']:
+        if options.group == 'zaccess' and options.zaction == 'exec':
+            zaccess_exec(cli, options)
+        elif options.group in [None, 'zaccess']:
             cli.select_node(getattr(options, 'node', None))
             cli.connect_node()
+        elif options.group == 'vm' and options.vmaction == 'action' and (options.match or options.all_cloudspaces or options.status):
+            bulk_vm_action(cli, options)
         elif options.group == 'vm':
             cloudspace = cli.select_cloudspace(options.cloudspace)
-            if options.vmaction == 'create':
-                cli.create_machine(cloudspace, options.name, options.memory, options.vcpus)
+            if options.vmaction == 'create' and (options.count > 1 or options.name_template):
+                template = options.name_template or (options.name or input('Enter name: ')) + '-{i}'
+                names = [template.format(i=i) for i in range(1, options.count + 1)]
+                results = cli.create_machines(cloudspace, names, options.memory, options.vcpus, workers=options.parallel, image=options.image)
+                failed = [name for name, _, error in results if error is not None]
+                print('Created {} of {} VMs'.format(len(names) - len(failed), len(names)))
+                running = True
+                if options.wait:
+                    vms = [dict(vm, cloudspaceId=cloudspace['id']) for _, vm, error in results if error is None]
+                    running = wait_for_vms(cli, vms, 'RUNNING', options.timeout)
+                    if running:
+                        print('{} VMs running'.format(len(vms)))
+                if failed:
+                    sys.exit('Failed: {}'.format(', '.join(failed)))
+                if not running:
+                    sys.exit(1)
+            elif options.vmaction == 'create':
+                vm = cli.create_machine(cloudspace, options.name, options.memory, options.vcpus, image=options.image)
+                if options.wait:
+                    if not wait_for_vms(cli, [dict(vm, cloudspaceId=cloudspace['id'])], 'RUNNING', options.timeout):
+                        sys.exit(1)
+                    print('VM {} running'.format(vm['name']))
+            elif options.vmaction == 'action':
+                vm = cli.select_vm(cloudspace, options.name)
+                if options.action == 'delete' and not options.yes:
+                    if input('Delete VM {}? [y/N] '.format(vm['name'])).lower() not in ['y', 'yes']:
+                        return
+                cli.vm_action(options.action, vm['id'])
+                if options.wait:
+                    from .client import ACTION_STATES
+                    state = ACTION_STATES[options.action]
+                    if not wait_for_vms(cli, [dict(vm, cloudspaceId=cloudspace['id'])], state, options.timeout):
+                        sys.exit(1)
+                    print('VM {} {}'.format(vm['name'], state))
+            elif options.vmaction == 'list' and options.watch:
+                watch_list(cli, options, cloudspace)
             elif options.vmaction == 'list':
                 cli.print_vms(cloudspace)
             elif options.vmaction == 'delete':
                 cli.delete_vm(cloudspace, options.name)
         elif options.group == 'cloudspace':
-            if options.csaction == "list":
+            if options.csaction == "list" and options.watch:
+                watch_list(cli, options)
+            elif options.csaction == "list":
                 cli.print_cloudspaces()
             elif options.csaction == "create":
                 cli.create_cloudspace(options.name, options.account, options.type)
             elif options.csaction == "delete":
                 cs = cli.select_cloudspace(options.name)
                 cli.delete_cloudspace(cs)
+        elif options.group == 'image':
+            if options.imageaction == 'list':
+                cli.print_images(cli.list_images(options.name, options.type))
         elif options.group == 'forwarding':
             cloudspace = cli.select_cloudspace(options.cloudspace)
-            if options.fwdaction == 'list':
-                cli.print_cloudspaces(cloudspace)
+            if options.fwdaction == 'list' and options.watch:
+                watch_list(cli, options, cloudspace)
+            elif options.fwdaction == 'list':
+                cli.print_forwards(cloudspace)
             elif options.fwdaction == 'create':
                 cli.create_forward(cloudspace, options.machine, options.publicport, options.privateport)
             elif options.fwdaction == 'delete':
                 cli.delete_forward(cloudspace, options.publicport)
+    except re.error as error:
+        parser.error('invalid regular expression: {}'.format(error))
     except KeyboardInterrupt:
         print('Fine be that way')
 
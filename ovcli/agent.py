@@ -0,0 +1,285 @@
+"""Resident process that answers list commands for short lived ovcli calls.
+
+The agent keeps one warm client per environment: config, tokens, pooled
+HTTPS sessions, the response cache and image catalogs. ovcli forwards
+list commands to it over a unix socket as one JSON line and gets the output
+back as JSON lines ``{"out": ...}``, ``{"err": ...}`` and a final
+``{"exit": code}``, or ``{"fallback": reason}`` when the command has to run
+directly, e.g. because it needs interactive selection.
+"""
+import json
+import os
+import socket
+import sys
+
+SOCKETPATH = os.path.join(os.path.expanduser('~/.cache/ovcli'), 'agent', 'agent.sock')
+
+# Seconds to wait for a started agent to listen
+START_TIMEOUT = 5
+
+
+class Fallback(Exception):
+    """The command cannot run in the agent and should run directly."""
+
+
+def forwardable(options):
+    """Only list commands without interactive selection or per call cache flags are forwarded."""
+    action = {'vm': 'vmaction', 'cloudspace': 'csaction', 'forwarding': 'fwdaction', 'image': 'imageaction'}.get(options.group)
+    if action is None or getattr(options, action) != 'list' or getattr(options, 'watch', False):
+        return False
+    from .utils import is_pattern
+    if not options.env or options.no_cache or options.refresh or options.profile or options.trace_file:
+        return False
+    # several environments are listed directly
+    if is_pattern(options.env, options.match_mode):
+        return False
+    return options.group in ['cloudspace', 'image'] or bool(options.cloudspace)
+
+
+def request(message, path=SOCKETPATH, timeout=None):
+    """Send a message to the agent and yield its replies, yields nothing when no agent listens."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+            sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        except OSError:
+            return
+        with sock.makefile('rb') as fd:
+            for line in fd:
+                yield json.loads(line.decode('utf-8'))
+    finally:
+        sock.close()
+
+
+def forward(argv, path=SOCKETPATH):
+    """
+    Run a command in the agent
+
+    :param argv: Command line arguments without the program name
+    :type argv: list
+    :return: Exit code, None when the command has to run directly
+    :rtype: int
+    """
+    replied = False
+    try:
+        for reply in request({'argv': argv}, path):
+            if 'fallback' in reply:
+                return None
+            replied = True
+            if 'out' in reply:
+                sys.stdout.write(reply['out'])
+            elif 'err' in reply:
+                sys.stderr.write(reply['err'])
+            elif 'exit' in reply:
+                sys.stdout.flush()
+                return reply['exit']
+    except (OSError, ValueError):
+        pass
+    # the agent went away halfway, only rerun when nothing was printed yet
+    return 1 if replied else None
+
+
+class Output:
+    """File-like object sending writes to the caller as {"out": ...} lines on flush."""
+
+    def __init__(self, send, key='out'):
+        self.send = send
+        self.key = key
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size > 1 << 16:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.send({self.key: ''.join(self.buffer)})
+            self.buffer = []
+            self.size = 0
+
+
+class Agent:
+    """Keeps warm clients per environment and runs forwarded list commands.
+
+    :param path: Unix socket to listen on
+    :type path: str, optional
+    """
+
+    def __init__(self, path=SOCKETPATH):
+        import threading
+        import time
+        from .client import Client
+        self.path = path
+        self.base = Client()
+        self.clients = {}
+        self.catalogs = {}
+        self.cleared = time.time()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.server = None
+
+    def client(self, options):
+        """Copy of the warm client of the selected environment with the options of one call."""
+        import copy
+        import time
+        from .utils import filter_items
+        environments = filter_items(self.base.environments, options.env, options.match_mode)
+        if len(environments) != 1:
+            raise Fallback('{} environments match {}'.format(len(environments), options.env))
+        environment = environments[0]
+        with self.lock:
+            # image catalogs live in memory, drop them as often as the cache would
+            if self.cleared + (self.base.cache.ttl('cloudapi/images/list') or 0) < time.time():
+                self.catalogs.clear()
+                self.cleared = time.time()
+            base = self.clients.get(environment)
+            if base is None:
+                from .client import Client
+                base = Client(self.base.tokens, self.base.transport)
+                base.catalogs = self.catalogs
+                base.set_environment(environment)
+                # set up the cache once so every copy shares it
+                base.cache
+                self.clients[environment] = base
+        cli = copy.copy(base)
+        cli.match_mode = options.match_mode
+        cli.output = options.output
+        cli.fields = options.fields.split(',') if options.fields else None
+        return cli
+
+    def select_cloudspace(self, cli, match):
+        from .utils import filter_items
+        cloudspaces = {cs['name']: cs for cs in cli.list_cloudspaces()}
+        names = filter_items(list(cloudspaces), match, cli.match_mode)
+        if not names:
+            raise LookupError('Could not find item with filter {}'.format(match))
+        if len(names) > 1:
+            raise Fallback('{} cloudspaces match {}'.format(len(names), match))
+        return cloudspaces[names[0]]
+
+    def run(self, argv, send):
+        from .output import get_writer
+        from .parsers import parser
+        try:
+            options = parser.parse_args(argv)
+        except SystemExit:
+            raise Fallback('invalid arguments')
+        if not forwardable(options):
+            raise Fallback('not forwardable')
+        cli = self.client(options)
+        kind = {'vm': 'vm', 'cloudspace': 'cloudspace', 'forwarding': 'forward', 'image': 'image'}[options.group]
+        if options.group in ['vm', 'forwarding']:
+            cloudspace = self.select_cloudspace(cli, options.cloudspace)
+        writer = get_writer(kind, cli.output, cli.fields, Output(send))
+        if options.group == 'image':
+            cli.print_images(cli.list_images(options.name, options.type), writer)
+        elif options.group == 'cloudspace':
+            cli.print_cloudspaces(writer=writer)
+        elif options.group == 'vm':
+            cli.print_vms(cloudspace, writer=writer)
+        else:
+            cli.print_forwards(cloudspace, writer=writer)
+        writer.close()
+
+    def status(self):
+        import time
+        return {'pid': os.getpid(), 'uptime': time.time() - self.started, 'requests': self.requests,
+                'environments': sorted(self.clients)}
+
+    def handle(self, message, send):
+        with self.lock:
+            self.requests += 1
+        if message.get('command') == 'status':
+            send(self.status())
+        elif message.get('command') == 'stop':
+            import threading
+            send({'exit': 0})
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+        else:
+            try:
+                self.run(message['argv'], send)
+            except Fallback as error:
+                return send({'fallback': str(error)})
+            except Exception as error:
+                send({'err': '{}\n'.format(error)})
+                return send({'exit': 1})
+            send({'exit': 0})
+
+    def serve(self):
+        import socketserver
+        agent = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                if not line:
+                    return
+
+                def send(reply):
+                    self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+
+                agent.handle(json.loads(line.decode('utf-8')), send)
+
+        class Server(socketserver.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        if os.path.exists(self.path):
+            if running(self.path):
+                raise RuntimeError('An agent is already listening on {}'.format(self.path))
+            os.remove(self.path)
+        umask = os.umask(0o077)
+        try:
+            self.server = Server(self.path, Handler)
+        finally:
+            os.umask(umask)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def running(path=SOCKETPATH):
+    return next(request({'command': 'status'}, path, timeout=2), None)
+
+
+def start(path=SOCKETPATH):
+    """Start an agent in the background and wait until it listens, returns its status."""
+    import subprocess
+    import time
+    status = running(path)
+    if status:
+        return status
+    logfile = os.path.join(os.path.dirname(path), 'agent.log')
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    with open(logfile, 'a') as log:
+        subprocess.Popen([sys.executable, '-m', 'ovcli', 'agent', 'run'], stdin=subprocess.DEVNULL,
+                         stdout=log, stderr=log, start_new_session=True)
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        status = running(path)
+        if status:
+            return status
+        time.sleep(0.05)
+    raise TimeoutError('Agent did not start within {}s, see {}'.format(START_TIMEOUT, logfile))
+
+
+def stop(path=SOCKETPATH):
+    """Stop a running agent and wait until it stopped listening, returns False when none was running."""
+    import time
+    if next(request({'command': 'stop'}, path, timeout=5), None) is None:
+        return False
+    deadline = time.time() + START_TIMEOUT
+    while os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.05)
+    return True
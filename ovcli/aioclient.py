@@ -0,0 +1,93 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .client import Client
+
+
+class AsyncClient:
+    """Asyncio front-end for :class:`Client`.
+
+    Every call goes through the same ``Client.api`` request layer, so both
+    clients build identical requests. Calls are dispatched on a bounded pool
+    that shares one pooled HTTP session: hundreds of coroutines can be
+    gathered at once while at most ``concurrency`` requests are in flight,
+    each of them on one of the pool threads.
+
+    :param client: Client to wrap, a new one is created when omitted
+    :type client: Client, optional
+    :param concurrency: Maximum amount of requests in flight, defaults to 16
+    :type concurrency: int, optional
+    """
+
+    def __init__(self, client=None, concurrency=16):
+        self.client = client or Client()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.client.transport.resize(concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: func(*args))
+
+    @property
+    def environment(self):
+        return self.client.environment
+
+    async def set_environment(self, environment):
+        return await self._run(self.client.set_environment, environment)
+
+    async def api(self, path, data=None):
+        return await self._run(self.client.api, path, data)
+
+    async def list_nodes(self):
+        return await self._run(self.client.list_nodes)
+
+    async def list_accounts(self):
+        return await self._run(self.client.list_accounts)
+
+    async def list_cloudspaces(self):
+        return await self._run(self.client.list_cloudspaces)
+
+    async def list_vms(self, cloudspace):
+        return await self._run(self.client.list_vms, cloudspace)
+
+    async def list_forwards(self, cloudspace):
+        return await self._run(self.client.list_forwards, cloudspace)
+
+    async def get_vm(self, vmid):
+        return await self._run(self.client.get_vm, vmid)
+
+    async def vm_action(self, action, vmid):
+        return await self._run(self.client.vm_action, action, vmid)
+
+    async def wait_for_state(self, vms, state, timeout=300):
+        return await self._run(self.client.wait_for_state, vms, state, timeout)
+
+    async def create_machine(self, cloudspace, name, memory, vcpus, forward=True, image=None):
+        return await self._run(self.client.create_machine, cloudspace, name, memory, vcpus, forward, image)
+
+    async def list_images(self, match=None, ostype=None):
+        return await self._run(self.client.list_images, match, ostype)
+
+    async def delete_vm_by_id(self, vmid):
+        return await self._run(self.client.delete_vm_by_id, vmid)
+
+    async def create_forward(self, cloudspace, machine, publicport, privateport):
+        return await self._run(self.client.create_forward, cloudspace, machine, publicport, privateport)
+
+    async def delete_forward(self, cloudspace, publicport):
+        return await self._run(self.client.delete_forward, cloudspace, publicport)
+
+    async def create_cloudspace(self, name, account, cstype):
+        return await self._run(self.client.create_cloudspace, name, account, cstype)
+
+    async def delete_cloudspace(self, cloudspace):
+        return await self._run(self.client.delete_cloudspace, cloudspace)
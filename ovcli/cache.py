@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+CACHEDIR = os.path.expanduser('~/.cache/ovcli')
+
+# Seconds a response of these endpoints stays valid, can be overridden per
+# endpoint in the [cache] section of ovc.cfg
+TTLS = {
+    'cloudapi/accounts/list': 300,
+    'cloudapi/cloudspaces/list': 60,
+    'cloudapi/images/list': 3600,
+    'cloudapi/machines/list': 30,
+    'cloudapi/portforwarding/list': 30,
+    'system/gridmanager/getNodes': 300,
+}
+
+# Cached endpoints listing the contents of one cloudspace, stored per cloudspaceId
+SCOPED = {'cloudapi/machines/list', 'cloudapi/portforwarding/list'}
+
+# Cached endpoints to drop when a mutating endpoint is called
+INVALIDATES = {
+    'cloudapi/cloudspaces/create': ['cloudapi/cloudspaces/list'],
+    'cloudbroker/cloudspace/destroy': ['cloudapi/cloudspaces/list', 'cloudapi/machines/list', 'cloudapi/portforwarding/list'],
+    'cloudapi/machines/create': ['cloudapi/machines/list'],
+    'cloudapi/machines/delete': ['cloudapi/machines/list', 'cloudapi/portforwarding/list'],
+    'cloudapi/machines/start': ['cloudapi/machines/list'],
+    'cloudapi/machines/stop': ['cloudapi/machines/list'],
+    'cloudapi/machines/reboot': ['cloudapi/machines/list'],
+    'cloudapi/machines/pause': ['cloudapi/machines/list'],
+    'cloudapi/machines/resume': ['cloudapi/machines/list'],
+    'cloudapi/machines/resize': ['cloudapi/machines/list'],
+    'cloudapi/portforwarding/create': ['cloudapi/portforwarding/list'],
+    'cloudapi/portforwarding/deleteByPort': ['cloudapi/portforwarding/list'],
+}
+
+
+class ResponseCache:
+    """On-disk cache of list responses, one directory per environment.
+
+    Entries are stored as ``<endpoint>[-<cloudspaceId>][-<hash>].json`` so a
+    mutating call on a cloudspace only drops the entries of that cloudspace.
+
+    :param ttls: Overrides for the default time to live per endpoint
+    :type ttls: dict, optional
+    """
+
+    def __init__(self, ttls=None, path=CACHEDIR):
+        self.path = path
+        self.ttls = {key.lower(): value for key, value in TTLS.items()}
+        self.ttls.update({key.lower(): int(value) for key, value in (ttls or {}).items()})
+        self.enabled = True
+        self.refresh = False
+
+    def ttl(self, endpoint):
+        return self.ttls.get(endpoint.lower())
+
+    def _prefix(self, environment, endpoint, scope=None):
+        name = endpoint.replace('/', '.')
+        if scope is not None:
+            name += '-{}'.format(scope)
+        return os.path.join(self.path, environment, name)
+
+    def _filename(self, environment, endpoint, data):
+        data = dict(data or {})
+        scope = data.pop('cloudspaceId', None)
+        filename = self._prefix(environment, endpoint, scope)
+        if data:
+            digest = hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+            filename += '-{}'.format(digest[:12])
+        return filename + '.json'
+
+    def get(self, environment, endpoint, data=None):
+        ttl = self.ttl(endpoint)
+        if not self.enabled or self.refresh or ttl is None:
+            return None
+        filename = self._filename(environment, endpoint, data)
+        try:
+            if os.path.getmtime(filename) + ttl < time.time():
+                return None
+            with open(filename) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, environment, endpoint, data, response):
+        if not self.enabled or self.ttl(endpoint) is None:
+            return
+        filename = self._filename(environment, endpoint, data)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmpname = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+        with open(tmpname, 'w') as fd:
+            json.dump(response, fd)
+        os.replace(tmpname, filename)
+
+    def invalidate(self, environment, endpoint, data=None):
+        scope = (data or {}).get('cloudspaceId')
+        for cached in INVALIDATES.get(endpoint, []):
+            prefix = os.path.basename(self._prefix(environment, cached, scope if cached in SCOPED else None))
+            directory = os.path.join(self.path, environment)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                return
+            for name in names:
+                if name == prefix + '.json' or name.startswith(prefix + '-'):
+                    try:
+                        os.remove(os.path.join(directory, name))
+                    except OSError:
+                        pass
@@ -1,130 +1,208 @@
 #!/usr/bin/env python3
-import requests
 from configparser import ConfigParser
+import fnmatch
 import os
+import random
 import subprocess
+import threading
 import time
-import json
-from .utils import base64url_decode, select_item
-
-COLORRED = u"\u001b[31m"
-RESET_COLOR = u"\u001b[0m"
-COLORBLUE = u"\u001b[34m"
-COLORGREEN = u"\u001b[32m"
+from .cache import ResponseCache
+from .images import ImageCatalog
+from .instrument import timed
+from .output import get_writer
+from .ports import DEFAULT_RANGE, PortAllocator, parse_range
+from .tokens import TokenStore
+from .utils import RateLimiter, fanout, filter_items, is_pattern, jwt_claims, select_item, match_items, print_line
+from .zaccess import CONTROL_PERSIST, DEFAULT_TTL, ProvisionCache, node_ip, run_remote, ssh_command
+
+# Status a vm ends up in after an action
+ACTION_STATES = {
+    'start': 'RUNNING',
+    'stop': 'HALTED',
+    'reboot': 'RUNNING',
+    'pause': 'PAUSED',
+    'resume': 'RUNNING',
+    'delete': 'DELETED',
+}
 
 
 class Client:
-    def __init__(self):
-        self.config = ConfigParser()
+    def __init__(self, tokens=None, transport=None):
+        # config, transport, cache and tokens are only set up once a command needs them
         self.configpath = os.path.expanduser('~/.config/ovc.cfg')
-        with open(self.configpath) as fd:
-            self.config.read_file(fd)
-        self.environments = list(self.config['environments'].keys())
+        self._config = None
+        self._transport = transport
+        self._cache = None
+        self._tokens = tokens
+        self._provisions = None
         self.node = None
         self.environment = None
-        self.session = requests.Session()
+        self.allocators = {}
+        self.catalogs = {}
+        self.match_mode = 'substring'
+        self.output = 'text'
+        self.fields = None
+        self.lock = threading.Lock()
+
+    @property
+    def config(self):
+        if self._config is None:
+            config = ConfigParser()
+            with open(self.configpath) as fd:
+                config.read_file(fd)
+            self._config = config
+        return self._config
+
+    @property
+    def environments(self):
+        return list(self.config['environments'].keys())
+
+    @property
+    def transport(self):
+        if self._transport is None:
+            from .transport import Transport
+            self._transport = Transport.from_config(self.config)
+        return self._transport
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            ttls = self.config['cache'] if self.config.has_section('cache') else None
+            self._cache = ResponseCache(ttls)
+        return self._cache
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            seed = {key[4:]: value for key, value in self.config['iyo'].items() if key.startswith('jwt.')}
+            self._tokens = TokenStore(self.fetch_jwt, seed)
+        return self._tokens
+
+    @property
+    def provisions(self):
+        if self._provisions is None:
+            options = self.config['zaccess'] if self.config.has_section('zaccess') else {}
+            self._provisions = ProvisionCache(int(options.get('ttl', DEFAULT_TTL)))
+        return self._provisions
+
+    @property
+    def control_persist(self):
+        if self.config.has_section('zaccess'):
+            return int(self.config['zaccess'].get('persist', CONTROL_PERSIST))
+        return CONTROL_PERSIST
 
     def is_jwt_expired(self, jwt):
-        jwt = jwt.encode('utf-8')
-        signing_input, _ = jwt.rsplit(b'.', 1)
-        _, claims_segment = signing_input.split(b'.', 1)
-        claimsdata = base64url_decode(claims_segment)
-        if isinstance(claimsdata, bytes):
-            claimsdata = claimsdata.decode('utf-8')
-        data = json.loads(claimsdata)
-        return data['exp'] < time.time()
+        return jwt_claims(jwt)['exp'] < time.time()
 
-    def get_jwt(self):
-        jwtkey = 'jwt.{}'.format(self.environment)
-        jwt = self.config['iyo'].get(jwtkey)
-        if jwt and not self.is_jwt_expired(jwt):
-            return jwt
-        iyourl = 'https://itsyou.online/v1/oauth/access_token'
+    def fetch_jwt(self, environment):
+        iyourl = self.config['iyo'].get('url', 'https://itsyou.online/v1/oauth/access_token')
         data = {'grant_type': 'client_credentials',
                   'client_id': self.config['iyo']['clientId'],
                   'client_secret': self.config['iyo']['clientsecret'],
                   'response_type': 'id_token',
-                  'scope': 'user:memberof:{0}.0-access,user:publickey:ssh'.format(self.environment)
+                  'scope': 'user:memberof:{0}.0-access,user:publickey:ssh'.format(environment)
         }
-        resp = requests.post(iyourl, data=data, headers={'Accept': 'application/json'})
+        resp = self.transport.post(iyourl, data=data, environment=environment)
         resp.raise_for_status()
-        jwt = resp.json()['access_token']
-        self.config['iyo'][jwtkey] = jwt
-        with open(self.configpath, 'w+') as fd:
-            self.config.write(fd)
-        return jwt
+        return resp.json()['access_token']
+
+    def get_jwt(self):
+        return self.tokens.get(self.environment)
+
+    def match_environments(self, pattern):
+        return match_items(self.environments, pattern)
 
     def select_environment(self, match=None):
-        self.set_environment(select_item(self.environments, "Select environment:  ", match))
+        self.set_environment(select_item(self.environments, "Select environment:  ", match, self.match_mode))
 
     def set_environment(self, environment):
         self.environment = environment
         self.envurl = self.config['environments'][self.environment]
-        self.session.headers = {'Authorization': 'Bearer {}'.format(self.get_jwt()),
-                                'Accept': 'application/json'}
+        self.baseurl = self.envurl if '://' in self.envurl else 'https://{}'.format(self.envurl)
+        self.get_jwt()
+
+    @property
+    def session(self):
+        return self.transport.session(self.baseurl)
+
+    def api(self, path, data=None, cached=True, parse=True):
+        result = None
+        if cached:
+            with timed('cache', path, environment=self.environment) as span:
+                result = self.cache.get(self.environment, path, data)
+                span['hit'] = result is not None
+        if result is not None:
+            return result
+        headers = {'Authorization': 'Bearer {}'.format(self.get_jwt())}
+        url = '{}/restmachine/{}'.format(self.baseurl, path)
+        response = self.transport.post(url, path, json=data, headers=headers, environment=self.environment)
+        response.raise_for_status()
+        # deletes and forwards answer without a body worth parsing
+        result = response.json() if parse else None
+        self.cache.put(self.environment, path, data, result)
+        self.cache.invalidate(self.environment, path, data)
+        return result
 
     def list_nodes(self):
-        response = self.session.post('https://{}/restmachine/system/gridmanager/getNodes'.format(self.envurl))
-        response.raise_for_status()
-        self.nodes = response.json()
+        self.nodes = self.api('system/gridmanager/getNodes')
         nodenames = [node['name'] for node in self.nodes]
         return nodenames
 
     def select_node(self, match=None):
         nodenames = self.list_nodes()
-        nodename = select_item(nodenames, "Select node: ", match)
+        nodename = select_item(nodenames, "Select node: ", match, self.match_mode)
         self.set_node(nodename)
 
     def set_node(self, nodename):
         self.node = list(filter(lambda node: node['name'] == nodename, self.nodes))[0]
 
     def select_cloudspace(self, match=None):
-        response = self.session.post('https://{}/restmachine/cloudapi/cloudspaces/list'.format(self.envurl))
-        response.raise_for_status()
-        cloudspaces = {cs['name']: cs for cs in response.json()}
-        cloudspacename = select_item(list(cloudspaces.keys()), "Select Cloudspace: ", match)
+        cloudspaces = {cs['name']: cs for cs in self.list_cloudspaces()}
+        cloudspacename = select_item(list(cloudspaces.keys()), "Select Cloudspace: ", match, self.match_mode)
         return cloudspaces[cloudspacename]
 
     def select_account(self, match=None):
-        response = self.session.post('https://{}/restmachine/cloudapi/accounts/list'.format(self.envurl))
-        response.raise_for_status()
-        cloudspaces = {cs['name']: cs for cs in response.json()}
-        cloudspacename = select_item(list(cloudspaces.keys()), "Select Account: ", match)
-        return cloudspaces[cloudspacename]
+        accounts = {account['name']: account for account in self.list_accounts()}
+        accountname = select_item(list(accounts.keys()), "Select Account: ", match, self.match_mode)
+        return accounts[accountname]
+
+    def list_accounts(self):
+        return self.api('cloudapi/accounts/list')
 
     def select_vm(self, cloudspace, match=None):
         vms = {vm['name']: vm for vm in self.list_vms(cloudspace)}
-        vmname = select_item(list(vms.keys()), "Select VM: ", match)
+        vmname = select_item(list(vms.keys()), "Select VM: ", match, self.match_mode)
         return vms[vmname]
 
-    def list_vms(self, cloudspace):
-        response = self.session.post('https://{}/restmachine/cloudapi/machines/list'.format(self.envurl), json={'cloudspaceId': cloudspace['id']})
-        response.raise_for_status()
-        return response.json()
+    def list_vms(self, cloudspace, cached=True):
+        return self.api('cloudapi/machines/list', {'cloudspaceId': cloudspace['id']}, cached)
 
-    def print_vms(self, cloudspace, vms=None):
+    def write_records(self, kind, records, writer=None, extra=None):
+        close = writer is None
+        if writer is None:
+            writer = get_writer(kind, self.output, self.fields)
+        for record in records:
+            writer.write(record, extra)
+        if close:
+            writer.close()
+
+    def print_vms(self, cloudspace, vms=None, environment=None, writer=None):
         if vms is None:
             vms = self.list_vms(cloudspace)
-        for vm in vms:
-            color = COLORBLUE
-            if vm['status'] == 'RUNNING':
-                color = COLORGREEN
-            elif vm['status'] == 'HALTED':
-                color = COLORRED
-            vm['color'] = color
-            vm['reset'] = RESET_COLOR
-            print("{name} {color}{status}{reset}".format(**vm))
+        extra = {'environment': environment, 'cloudspace': cloudspace['name']} if environment else None
+        self.write_records('vm', vms, writer, extra)
+
+    def get_vm(self, vmid):
+        return self.api('cloudapi/machines/get', {'machineId': vmid})
 
     def list_cloudspaces(self):
-        response = self.session.post('https://{}/restmachine/cloudapi/cloudspaces/list'.format(self.envurl))
-        response.raise_for_status()
-        return response.json()
+        return self.api('cloudapi/cloudspaces/list')
 
-    def print_cloudspaces(self, cloudspaces=None):
+    def print_cloudspaces(self, cloudspaces=None, environment=None, writer=None):
         if cloudspaces is None:
             cloudspaces = self.list_cloudspaces()
-        for cloudspace in cloudspaces:
-            print("{name} {status} {externalnetworkip}".format(**cloudspace))
+        extra = {'environment': environment} if environment else None
+        self.write_records('cloudspace', cloudspaces, writer, extra)
 
     def delete_vm(self, cloudspace, name):
         vm = self.select_vm(cloudspace, name)
@@ -132,21 +210,224 @@ class Client:
 
     def delete_vm_by_id(self, vmid):
         data = {'machineId': vmid, 'permanently': True}
-        response = self.session.post('https://{}/restmachine/cloudapi/machines/delete'.format(self.envurl), json=data)
-        response.raise_for_status()
+        self.api('cloudapi/machines/delete', data, parse=False)
 
     def delete_cloudspace(self, cloudspace):
         data = {'cloudspaceId': cloudspace['id'], 'permanently': True, 'reason': 'From CLI'}
-        response = self.session.post('https://{}/restmachine/cloudbroker/cloudspace/destroy'.format(self.envurl), json=data)
-        response.raise_for_status()
+        self.api('cloudbroker/cloudspace/destroy', data, parse=False)
+
+    def resize_vm(self, vmid, memory, vcpus):
+        data = {'machineId': vmid, 'memory': memory, 'vcpus': vcpus}
+        return self.api('cloudapi/machines/resize', data)
 
     def vm_action(self, action, vmid):
+        if action == 'delete':
+            return self.delete_vm_by_id(vmid)
         data = {'machineId': vmid}
-        response = self.session.post('https://{}/restmachine/cloudapi/machines/{}'.format(self.envurl, action), json=data)
-        response.raise_for_status()
-        return response.json()
+        return self.api('cloudapi/machines/{}'.format(action), data)
 
-    def create_machine(self, cloudspace, name=None, memory=None, vcpus=None, forward=True):
+    def match_vms(self, cloudspaces, match=None, statuses=None, cached=True):
+        """
+        List the vms of several cloudspaces at once and filter them
+
+        :param match: Glob pattern the vm name has to match
+        :type match: str, optional
+        :param statuses: Statuses to keep e.g. ['RUNNING']
+        :type statuses: list, optional
+        :param cached: Use cached vm lists, defaults to True
+        :type cached: bool, optional
+        :return: List of (cloudspace, vm) tuples
+        :rtype: list
+        """
+        matches = []
+        for cloudspace, vms, error in fanout(lambda cs: self.list_vms(cs, cached), cloudspaces):
+            if error is not None:
+                raise error
+            for vm in vms:
+                if match and not fnmatch.fnmatchcase(vm['name'], match):
+                    continue
+                if statuses and vm['status'] not in statuses:
+                    continue
+                matches.append((cloudspace, vm))
+        return matches
+
+    def bulk_vm_action(self, action, targets, workers=8, rate=None):
+        """
+        Run an action on many vms in parallel
+
+        :param targets: List of (cloudspace, vm) tuples, as returned by match_vms
+        :type targets: list
+        :param workers: Amount of actions running at once, defaults to 8
+        :type workers: int, optional
+        :param rate: Maximum amount of API calls per second, defaults to unlimited
+        :type rate: float, optional
+        :return: List of ((cloudspace, vm), result, error) tuples
+        :rtype: list
+        """
+        limiter = RateLimiter(rate)
+
+        def run(target):
+            cloudspace, vm = target
+            limiter.wait()
+            try:
+                result = self.vm_action(action, vm['id'])
+            except Exception as error:
+                print_line('{} {}: failed: {}'.format(cloudspace['name'], vm['name'], error))
+                raise
+            print_line('{} {}: {} ok'.format(cloudspace['name'], vm['name'], action))
+            return result
+
+        return fanout(run, targets, workers)
+
+    def wait_for_state(self, vms, state, timeout=300, interval=2, max_interval=15):
+        """
+        Wait until virtual machines reach a status
+
+        VMs are polled together with one machines/list call per cloudspace,
+        the delay between polls grows with some jitter while waiting.
+
+        :param vms: Virtual machines to wait for, need an id and cloudspace id
+        :type vms: list
+        :param state: Status to wait for e.g. RUNNING, DELETED waits for the vms to disappear
+        :type state: str
+        :param timeout: Seconds to wait before giving up, defaults to 300
+        :type timeout: int, optional
+        :raises TimeoutError: When not all vms reached the status in time
+        :return: Status per vm id
+        :rtype: dict
+        """
+        pending = {}
+        for vm in vms:
+            cloudspaceid = vm.get('cloudspaceId', vm.get('cloudspaceid'))
+            pending.setdefault(cloudspaceid, set()).add(vm['id'])
+        statuses = {}
+        deadline = time.time() + timeout
+        delay = interval
+        while True:
+            results = fanout(lambda csid: self.list_vms({'id': csid}, cached=False), list(pending))
+            for cloudspaceid, listed, error in results:
+                if error is not None:
+                    continue
+                current = {vm['id']: vm['status'] for vm in listed}
+                for vmid in list(pending[cloudspaceid]):
+                    status = current.get(vmid, 'DELETED')
+                    statuses[vmid] = status
+                    if status == state:
+                        pending[cloudspaceid].discard(vmid)
+                if not pending[cloudspaceid]:
+                    del pending[cloudspaceid]
+            if not pending:
+                return statuses
+            if time.time() + delay > deadline:
+                names = {vm['id']: vm.get('name', vm['id']) for vm in vms}
+                waiting = sorted(str(names[vmid]) for vmids in pending.values() for vmid in vmids)
+                raise TimeoutError('VMs {} did not reach {} within {}s'.format(', '.join(waiting), state, timeout))
+            time.sleep(delay)
+            delay = min(delay * 1.5, max_interval) * random.uniform(0.8, 1.2)
+
+    def image_catalog(self):
+        with self.lock:
+            if self.environment not in self.catalogs:
+                self.catalogs[self.environment] = ImageCatalog(self.api('cloudapi/images/list'))
+            return self.catalogs[self.environment]
+
+    def list_images(self, match=None, ostype=None):
+        return self.image_catalog().find(match, ostype)
+
+    def print_images(self, images=None, writer=None):
+        if images is None:
+            images = self.list_images()
+        self.write_records('image', images, writer)
+
+    def get_image_id(self, image=None):
+        return self.image_catalog().resolve(image)['id']
+
+    def get_userdata(self):
+        keyfile = os.path.expanduser('~/.ssh/id_rsa.pub')
+        if not os.path.exists(keyfile):
+            return None
+        pubkey = open(keyfile).read()
+        return {'users': [{"name":'root', "ssh-authorized-keys": [pubkey], 'shell': '/bin/bash'}]}
+
+    def create_vm(self, cloudspace, name, memory, vcpus, imageId, userdata=None):
+        data = {
+            'cloudspaceId': cloudspace['id'],
+            'name': name,
+            'description': name,
+            'memory': memory,
+            'vcpus': vcpus,
+            'imageId': imageId,
+            'disksize': 100,
+            'userdata': userdata,
+        }
+        machineId = self.api('cloudapi/machines/create', data)
+        return self.get_vm(machineId)
+
+    def create_ssh_forward(self, cloudspace, vm, pubport=None, allocated=False):
+        pubport = self.add_forward(cloudspace, vm, 22, pubport, retry=True, allocated=allocated)
+        return 'ssh -p {} root@{}'.format(pubport, cloudspace['externalnetworkip'])
+
+    def port_allocator(self, cloudspace):
+        key = (self.environment, cloudspace['id'])
+        with self.lock:
+            allocator = self.allocators.get(key)
+        if allocator is None:
+            # list the forwards without the lock, the first allocator stored wins
+            usedports = [int(fwd['publicPort']) for fwd in self.list_forwards(cloudspace)]
+            portrange = DEFAULT_RANGE
+            if self.config.has_option('ports', 'range'):
+                portrange = parse_range(self.config['ports']['range'])
+            with self.lock:
+                allocator = self.allocators.setdefault(key, PortAllocator(usedports, portrange))
+        return allocator
+
+    def add_forward(self, cloudspace, vm, localport, publicport=None, retry=None, retries=10, allocated=False):
+        """
+        Forward a public port of the cloudspace to a port of a vm
+
+        When no public port is given one is allocated, when the API reports the
+        port is taken (e.g. by another ovcli run) the next free port is tried.
+        Ports taken by the API are kept marked as used, only ports handed out
+        by the allocator are released when the call fails otherwise.
+
+        :param allocated: The given public port was handed out by the allocator, defaults to False
+        :type allocated: bool, optional
+        :return: The public port that was forwarded
+        :rtype: int
+        """
+        from requests import HTTPError
+        allocator = self.port_allocator(cloudspace)
+        if retry is None:
+            retry = publicport is None
+        for _ in range(retries):
+            if publicport is None:
+                publicport = allocator.allocate()[0]
+                allocated = True
+            data = {
+                'cloudspaceId': cloudspace['id'],
+                'publicIp': cloudspace['externalnetworkip'],
+                'publicPort': publicport,
+                'machineId': vm['id'],
+                'localPort': localport,
+                'protocol': 'tcp'
+            }
+            try:
+                self.api('cloudapi/portforwarding/create', data, parse=False)
+                allocator.mark_used(publicport)
+                return publicport
+            except HTTPError as error:
+                if error.response is not None and error.response.status_code == 409:
+                    allocator.mark_used(publicport)
+                    if not retry:
+                        raise
+                    publicport = None
+                    continue
+                if allocated:
+                    allocator.release(publicport)
+                raise
+        raise LookupError('Could not find a free public port after {} attempts'.format(retries))
+
+    def create_machine(self, cloudspace, name=None, memory=None, vcpus=None, forward=True, image=None):
         """
         Create virtual machine
         
@@ -158,6 +439,8 @@ class Client:
         :param memory: int, optional
         :param vcpus: Amount of virtual CPUS to provide to the virtual machine, defaults to None
         :param vcpus: int, optional
+        :param image: Id, name or glob of the image to use, defaults to Ubuntu 16.04
+        :param image: str, optional
         :raises LookupError: [description]
         """
 
@@ -167,85 +450,71 @@ class Client:
             memory = int(input('Memory: '))
         if vcpus is None:
             vcpus = int(input('VCPUS: '))
-        response = self.session.post('https://{}/restmachine/cloudapi/images/list'.format(self.envurl))
-        response.raise_for_status()
-        for image in response.json():
-            if 'Ubuntu 16.04' in image['name']:
-                imageId = image['id']
-                break
-        else:
-            raise LookupError('Could not find Ubuntu image')
-        keyfile = os.path.expanduser('~/.ssh/id_rsa.pub')
-        userdata = None
-        if os.path.exists(keyfile):
-            pubkey = open(keyfile).read()
-            userdata = {'users': [{"name":'root', "ssh-authorized-keys": [pubkey], 'shell': '/bin/bash'}]}
-
-        data = {
-            'cloudspaceId': cloudspace['id'],
-            'name': name,
-            'description': name,
-            'memory': memory,
-            'vcpus': vcpus,
-            'imageId': imageId,
-            'disksize': 100,
-            'userdata': userdata,
-        }
+        imageId = self.get_image_id(image)
         print('Creating VM')
-        response = self.session.post('https://{}/restmachine/cloudapi/machines/create'.format(self.envurl), json=data)
-        response.raise_for_status()
-        machineId = response.json()
-        response = self.session.post('https://{}/restmachine/cloudapi/machines/get'.format(self.envurl), json={'machineId': machineId})
-        response.raise_for_status()
-        vm = response.json()
+        vm = self.create_vm(cloudspace, name, memory, vcpus, imageId, self.get_userdata())
         print('VM {}: {}'.format(vm['name'], vm['interfaces'][0]['ipAddress']))
         for account in vm['accounts']:
             print('\tUser: {login} / {password}'.format(**account))
        
         if not forward:
             return
-        pubport = self.get_publicport(cloudspace)
-
-        data = {
-            'cloudspaceId': cloudspace['id'],
-            'publicIp': cloudspace['externalnetworkip'],
-            'publicPort': pubport,
-            'machineId': vm['id'],
-            'localPort': 22,
-            'protocol': 'tcp'
-        }
-        response = self.session.post('https://{}/restmachine/cloudapi/portforwarding/create'.format(self.envurl), json=data)
-        response.raise_for_status()
-        print('ssh -p {} root@{}'.format(pubport, cloudspace['externalnetworkip']))
+        print(self.create_ssh_forward(cloudspace, vm))
         return vm
 
+    def create_machines(self, cloudspace, names, memory, vcpus, forward=True, workers=8, image=None):
+        """
+        Create several identical virtual machines in parallel
+
+        The image list and the port forwards are fetched once and every vm gets
+        its own public port reserved up front. A failing vm is reported and does
+        not stop the others.
+
+        :param cloudspace: Cloudspace to create virtual machines in
+        :type cloudspace: dict
+        :param names: Names of the vms to create
+        :type names: list
+        :param workers: Amount of vms to create at once, defaults to 8
+        :type workers: int, optional
+        :param image: Id, name or glob of the image to use, defaults to Ubuntu 16.04
+        :type image: str, optional
+        :return: List of (name, vm, error) tuples
+        :rtype: list
+        """
+        imageId = self.get_image_id(image)
+        userdata = self.get_userdata()
+        pubports = dict(zip(names, self.get_publicports(cloudspace, len(names)))) if forward else {}
+
+        def create(name):
+            pubport = pubports.get(name)
+            try:
+                vm = self.create_vm(cloudspace, name, memory, vcpus, imageId, userdata)
+                line = 'VM {}: {}'.format(vm['name'], vm['interfaces'][0]['ipAddress'])
+                if forward:
+                    # add_forward releases or keeps the reserved port from here on
+                    port, pubport = pubport, None
+                    line += ' ' + self.create_ssh_forward(cloudspace, vm, port, allocated=True)
+            except Exception as error:
+                if pubport is not None:
+                    self.port_allocator(cloudspace).release(pubport)
+                print_line('VM {}: failed: {}'.format(name, error))
+                raise
+            print_line(line)
+            return vm
+
+        print('Creating {} VMs'.format(len(names)))
+        return fanout(create, names, workers)
+
     def get_publicport(self, cloudspace):
-        response = self.session.post('https://{}/restmachine/cloudapi/portforwarding/list'.format(self.envurl), json={'cloudspaceId': cloudspace['id']})
-        response.raise_for_status()
-        forwards = response.json()
-        pubport = 3500
-        usedports = [int(fwd['publicPort']) for fwd in forwards]
-        while pubport in usedports:
-            pubport += 1
-        return pubport
+        return self.get_publicports(cloudspace)[0]
+
+    def get_publicports(self, cloudspace, count=1):
+        return self.port_allocator(cloudspace).allocate(count)
 
     def create_forward(self, cloudspace, machine, publicport, privateport):
         vm = self.select_vm(cloudspace, machine)
-        if not publicport:
-            publicport = self.get_publicport(cloudspace)
-
-        data = {
-            'cloudspaceId': cloudspace['id'],
-            'publicIp': cloudspace['externalnetworkip'],
-            'publicPort': publicport,
-            'machineId': vm['id'],
-            'localPort': privateport,
-            'protocol': 'tcp'
-        }
-        response = self.session.post('https://{}/restmachine/cloudapi/portforwarding/create'.format(self.envurl), json=data)
-        response.raise_for_status()
-        data['name'] = vm['name']
-        print("{publicIp}:{publicPort} -> {name}:{localPort} {protocol}".format(**data))
+        publicport = self.add_forward(cloudspace, vm, privateport, int(publicport) if publicport else None)
+        print("{}:{} -> {}:{} tcp".format(cloudspace['externalnetworkip'], publicport, vm['name'], privateport))
 
     def delete_forward(self, cloudspace, publicport):
         data = {
@@ -253,55 +522,120 @@ class Client:
             'publicIp': cloudspace['externalnetworkip'],
             'publicPort': publicport,
         }
-        response = self.session.post('https://{}/restmachine/cloudapi/portforwarding/deleteByPort'.format(self.envurl), json=data)
-        response.raise_for_status()
+        self.api('cloudapi/portforwarding/deleteByPort', data, parse=False)
 
     def list_forwards(self, cloudspace):
-        response = self.session.post('https://{}/restmachine/cloudapi/portforwarding/list'.format(self.envurl), json={'cloudspaceId': cloudspace['id']})
-        response.raise_for_status()
-        return response.json()
+        return self.api('cloudapi/portforwarding/list', {'cloudspaceId': cloudspace['id']})
 
-    def print_forwards(self, cloudspace, forwards=None):
+    def print_forwards(self, cloudspace, forwards=None, environment=None, writer=None):
         if forwards is None:
             forwards = self.list_forwards(cloudspace)
-        for fwd in forwards:
-            print("{machineName} {publicIp}:{publicPort} -> {localIp}:{localPort} {protocol}".format(**fwd))
+        extra = {'environment': environment, 'cloudspace': cloudspace['name']} if environment else None
+        self.write_records('forward', forwards, writer, extra)
 
     def create_cloudspace(self, name, account, cstype):
         if name is None:
             name = input('Enter name: ')
-        account = self.select_account(account)['id']
-        data = {'accountId': account, 'name': name}
+        # an account can be selected up front, e.g. before creating on threads
+        if not isinstance(account, dict):
+            account = self.select_account(account)
+        data = {'accountId': account['id'], 'name': name}
         if cstype:
             data['type'] = cstype
-        whoami = self.session.post('https://{}/restmachine/system/usermanager/whoami'.format(self.envurl))
-        whoami.raise_for_status()
-        data['access'] = whoami.json()['name']
-        location = self.session.post('https://{}/restmachine/cloudapi/locations/list'.format(self.envurl))
-        location.raise_for_status()
-        data['location'] = location.json()[0]['locationCode']
-        response = self.session.post('https://{}/restmachine/cloudapi/cloudspaces/create'.format(self.envurl), json=data)
-        response.raise_for_status()
-
-    def connect_node(self, forward=True):
-        def get_nic_ip(iface):
-            for nic in self.node['netaddr']:
-                if nic['name'] == iface:
-                    for ip in nic['ip']:
-                        return ip
-            return None
-        nodeip = get_nic_ip('backplane1')
-        if not nodeip:
-            nodeip = self.node['ipaddr'][0]
+        data['access'] = self.api('system/usermanager/whoami')['name']
+        data['location'] = self.api('cloudapi/locations/list')[0]['locationCode']
+        return self.api('cloudapi/cloudspaces/create', data)
 
-        data = {'remote': nodeip}
-        response = self.session.post('https://{}/restmachine/cloudbroker/zeroaccess/provision'.format(self.envurl), json=data)
-        response.raise_for_status()
-        result = response.json()
-        cmd = ['ssh', '-p', str(result['ssh_port']), "{username}@{ssh_ip}".format(**result)]
-        if forward:
-            cmd.insert(1, '-A')
-        print('Executing: {}'.format(' '.join(cmd)))
-        subprocess.Popen(cmd).communicate()
+    def provision_node(self, node=None, refresh=False):
+        """
+        Provision zero-access to a node, reusing an earlier provisioning until it expires
+
+        :param node: Node to provision, defaults to the selected node
+        :type node: dict, optional
+        :param refresh: Ignore a cached provisioning, defaults to False
+        :type refresh: bool, optional
+        :return: Provisioning result and whether it came from the cache
+        :rtype: tuple
+        """
+        remote = node_ip(node or self.node)
+        if not refresh:
+            result = self.provisions.get(self.environment, remote)
+            if result:
+                return result, True
+        result = self.api('cloudbroker/zeroaccess/provision', {'remote': remote}, cached=False)
+        self.provisions.put(self.environment, remote, result)
+        return result, False
 
+    def connect_node(self, forward=True):
+        result, cached = self.provision_node(refresh=self.cache.refresh or not self.cache.enabled)
+        while True:
+            cmd = ssh_command(result, forward, self.control_persist)
+            print('Executing: {}'.format(' '.join(cmd)))
+            with timed('ssh', 'ssh', environment=self.environment):
+                returncode = subprocess.Popen(cmd).wait()
+            # 255 is ssh failing to connect, the cached provisioning might have been revoked
+            if returncode != 255 or not cached:
+                return returncode
+            self.provisions.invalidate(self.environment, node_ip(self.node))
+            result, cached = self.provision_node(refresh=True)
+
+    def match_nodes(self, match=None):
+        """Nodes whose name matches a glob pattern or the match mode, all nodes without match."""
+        names = self.list_nodes()
+        if match is None:
+            selected = names
+        elif is_pattern(match, self.match_mode):
+            selected = match_items(names, match)
+        else:
+            selected = filter_items(names, match, self.match_mode)
+        return [node for node in self.nodes if node['name'] in set(selected)]
 
+    def exec_nodes(self, nodes, command, workers=16, timeout=None, emit=None):
+        """
+        Run a command on several nodes at once over zero-access ssh
+
+        All nodes are provisioned concurrently before the commands start.
+
+        :param nodes: Nodes as returned by match_nodes
+        :type nodes: list
+        :param command: Remote command and its arguments
+        :type command: list
+        :param workers: Amount of nodes to run the command on at once, defaults to 16
+        :type workers: int, optional
+        :param timeout: Seconds after which the command is killed on a node
+        :type timeout: float, optional
+        :param emit: Callable taking a node name, stream name and line
+        :type emit: callable, optional
+        :return: Result dict per node name with exitcode, stdout, stderr, duration and error
+        :rtype: dict
+        """
+        refresh = self.cache.refresh or not self.cache.enabled
+        provisioned = fanout(lambda node: self.provision_node(node, refresh), nodes, workers)
+        results = {}
+        ready = []
+        for node, result, error in provisioned:
+            if error is not None:
+                results[node['name']] = {'exitcode': None, 'error': str(error)}
+            else:
+                ready.append((node, result))
+
+        def run(item):
+            node, (result, cached) = item
+
+            def output(stream, line):
+                if emit:
+                    emit(node['name'], stream, line)
+
+            while True:
+                cmd = ssh_command(result, False, self.control_persist, command, batch=True)
+                with timed('ssh', 'exec', environment=self.environment, node=node['name']):
+                    outcome = run_remote(cmd, output, timeout)
+                # 255 is ssh failing to connect, the cached provisioning might have been revoked
+                if outcome['exitcode'] != 255 or not cached:
+                    return outcome
+                self.provisions.invalidate(self.environment, node_ip(node))
+                result, cached = self.provision_node(node, refresh=True)
+
+        for (node, _), result, error in fanout(run, ready, workers):
+            results[node['name']] = result if error is None else {'exitcode': None, 'error': str(error)}
+        return {node['name']: results[node['name']] for node in nodes}
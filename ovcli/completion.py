@@ -0,0 +1,85 @@
+import bisect
+
+from prompt_toolkit.completion import Completion
+
+from .utils import FuzzyMatcher
+
+
+def trigrams(text):
+    return {text[idx:idx + 3] for idx in range(len(text) - 2)}
+
+
+class CompletionIndex:
+    """Prebuilt lookup structure for the completions of a shell component.
+
+    Keeps a sorted list of the entries for prefix lookups and a trigram index
+    for substring lookups, so completing and validating does not rescan all
+    entries on every keystroke. ``update`` only touches the entries that were
+    added or removed.
+    """
+
+    def __init__(self, items=()):
+        self.entries = {}
+        self.names = []
+        self.grams = {}
+        self.update(items)
+
+    def __contains__(self, text):
+        return text in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, item):
+        if not isinstance(item, Completion):
+            item = Completion(item)
+        text = item.text
+        if text in self.entries:
+            self.entries[text] = item
+            return
+        self.entries[text] = item
+        bisect.insort(self.names, text)
+        for gram in trigrams(text):
+            self.grams.setdefault(gram, set()).add(text)
+
+    def remove(self, text):
+        if self.entries.pop(text, None) is None:
+            return
+        del self.names[bisect.bisect_left(self.names, text)]
+        for gram in trigrams(text):
+            texts = self.grams[gram]
+            texts.discard(text)
+            if not texts:
+                del self.grams[gram]
+
+    def update(self, items):
+        items = [item if isinstance(item, Completion) else Completion(item) for item in items if item]
+        texts = {item.text for item in items}
+        for text in [text for text in self.entries if text not in texts]:
+            self.remove(text)
+        for item in items:
+            current = self.entries.get(item.text)
+            if current is None or current.style != item.style:
+                self.add(item)
+
+    def prefixed(self, text):
+        start = bisect.bisect_left(self.names, text)
+        end = bisect.bisect_left(self.names, text + '￿')
+        return self.names[start:end]
+
+    def containing(self, text):
+        if len(text) < 3:
+            return [name for name in self.entries if text in name]
+        grams = sorted((self.grams.get(gram, set()) for gram in trigrams(text)), key=len)
+        candidates = set.intersection(*grams) if grams else set()
+        return [name for name in candidates if text in name]
+
+    def complete(self, text):
+        if not text:
+            return list(self.entries.values())
+        names = self.prefixed(text)
+        seen = set(names)
+        names += sorted(name for name in self.containing(text) if name not in seen)
+        if not names:
+            names = FuzzyMatcher(self.entries).match(text)
+        return [Completion(name, -len(text), style=self.entries[name].style) for name in names]
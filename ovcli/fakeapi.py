@@ -0,0 +1,247 @@
+"""Local stand-in for the OpenvCloud restmachine API and itsyou.online.
+
+Serves a generated inventory over plain HTTP, with optional latency and
+error injection, so ovcli can be exercised and benchmarked without a G8::
+
+    python -m ovcli.fakeapi --vms 1000 --cloudspaces 10 --latency 0.05
+
+Point an environment at it in ovc.cfg::
+
+    [environments]
+    fake.environments.local = http://127.0.0.1:8080
+
+    [iyo]
+    url = http://127.0.0.1:8080/v1/oauth/access_token
+"""
+import argparse
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+def make_jwt(claims):
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).rstrip(b'=').decode('utf-8')
+    return '{}.{}.fake'.format(encode({'alg': 'none'}), encode(claims))
+
+
+class Inventory:
+    """Generated accounts, cloudspaces, vms, forwards, images and nodes."""
+
+    def __init__(self, vms=100, cloudspaces=10, nodes=8, forwards=1):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.accounts = [{'id': 1, 'name': 'account'}]
+        self.images = [
+            {'id': 1, 'name': 'Ubuntu 16.04 x64', 'type': 'Linux', 'status': 'CREATED'},
+            {'id': 2, 'name': 'Ubuntu 18.04 x64', 'type': 'Linux', 'status': 'CREATED'},
+            {'id': 3, 'name': 'Windows 2012r2 Standard', 'type': 'Windows', 'status': 'CREATED'},
+        ]
+        self.nodes = [{'id': idx, 'name': 'cpu-{:02d}'.format(idx), 'ipaddr': ['10.199.0.{}'.format(idx)],
+                       'netaddr': [{'name': 'backplane1', 'ip': ['10.107.0.{}'.format(idx)]}]}
+                      for idx in range(1, nodes + 1)]
+        self.cloudspaces = {}
+        self.vms = {}
+        self.forwards = {}
+        for idx in range(cloudspaces):
+            self.create_cloudspace('cs-{:04d}'.format(idx), 1)
+        csids = list(self.cloudspaces)
+        for idx in range(vms):
+            vm = self.create_vm(csids[idx % len(csids)], 'vm-{:06d}'.format(idx), 1024, 1)
+            for port in range(forwards):
+                cloudspace = self.cloudspaces[vm['cloudspaceid']]
+                self.create_forward(cloudspace['id'], cloudspace['externalnetworkip'],
+                                    3500 + len(self.forwards[cloudspace['id']]), vm['id'], 22 + port)
+
+    def create_cloudspace(self, name, accountid):
+        csid = next(self.ids)
+        self.cloudspaces[csid] = {'id': csid, 'name': name, 'accountId': accountid, 'status': 'DEPLOYED',
+                                  'externalnetworkip': '185.69.{}.{}'.format(csid // 250, csid % 250 + 1)}
+        self.forwards[csid] = []
+        return csid
+
+    def create_vm(self, csid, name, memory, vcpus):
+        vmid = next(self.ids)
+        self.vms[vmid] = {
+            'id': vmid, 'name': name, 'cloudspaceid': csid, 'status': 'RUNNING', 'memory': memory,
+            'vcpus': vcpus, 'interfaces': [{'ipAddress': '192.168.{}.{}'.format(vmid // 250 % 250, vmid % 250 + 1)}],
+            'accounts': [{'login': 'root', 'password': 'secret'}],
+        }
+        return self.vms[vmid]
+
+    def create_forward(self, csid, publicip, publicport, vmid, localport):
+        vm = self.vms[vmid]
+        self.forwards[csid].append({
+            'publicIp': publicip, 'publicPort': str(publicport), 'machineId': vmid, 'machineName': vm['name'],
+            'localIp': vm['interfaces'][0]['ipAddress'], 'localPort': str(localport), 'protocol': 'tcp',
+        })
+
+    def vm_summary(self, vm):
+        return {'id': vm['id'], 'name': vm['name'], 'status': vm['status'], 'cloudspaceId': vm['cloudspaceid'],
+                'memory': vm['memory'], 'vcpus': vm['vcpus']}
+
+    def handle(self, endpoint, data):
+        """Return (status, body) for an API call."""
+        with self.lock:
+            return self._handle(endpoint, data)
+
+    def _handle(self, endpoint, data):
+        states = {'start': 'RUNNING', 'stop': 'HALTED', 'reboot': 'RUNNING', 'pause': 'PAUSED', 'resume': 'RUNNING'}
+        if endpoint == 'cloudapi/accounts/list':
+            return 200, self.accounts
+        elif endpoint == 'cloudapi/cloudspaces/list':
+            return 200, list(self.cloudspaces.values())
+        elif endpoint == 'cloudapi/cloudspaces/create':
+            return 200, self.create_cloudspace(data['name'], data['accountId'])
+        elif endpoint == 'cloudbroker/cloudspace/destroy':
+            csid = data['cloudspaceId']
+            self.cloudspaces.pop(csid, None)
+            self.forwards.pop(csid, None)
+            for vmid in [vmid for vmid, vm in self.vms.items() if vm['cloudspaceid'] == csid]:
+                del self.vms[vmid]
+            return 200, True
+        elif endpoint == 'cloudapi/locations/list':
+            return 200, [{'locationCode': 'fake'}]
+        elif endpoint == 'system/usermanager/whoami':
+            return 200, {'name': 'fake'}
+        elif endpoint == 'cloudapi/images/list':
+            return 200, self.images
+        elif endpoint == 'system/gridmanager/getNodes':
+            return 200, self.nodes
+        elif endpoint == 'cloudbroker/zeroaccess/provision':
+            return 200, {'ssh_ip': '127.0.0.1', 'ssh_port': 22, 'username': 'fake', 'expiration': time.time() + 3600}
+        elif endpoint == 'cloudapi/machines/list':
+            return 200, [self.vm_summary(vm) for vm in self.vms.values() if vm['cloudspaceid'] == data['cloudspaceId']]
+        elif endpoint == 'cloudapi/machines/get':
+            vm = self.vms.get(data['machineId'])
+            return (200, vm) if vm else (404, {'error': 'Machine not found'})
+        elif endpoint == 'cloudapi/machines/create':
+            if data['cloudspaceId'] not in self.cloudspaces:
+                return 404, {'error': 'Cloudspace not found'}
+            return 200, self.create_vm(data['cloudspaceId'], data['name'], data['memory'], data['vcpus'])['id']
+        elif endpoint == 'cloudapi/machines/delete':
+            vm = self.vms.pop(data['machineId'], None)
+            if vm:
+                forwards = self.forwards[vm['cloudspaceid']]
+                forwards[:] = [fwd for fwd in forwards if fwd['machineId'] != vm['id']]
+            return 200, True
+        elif endpoint == 'cloudapi/machines/resize':
+            vm = self.vms.get(data['machineId'])
+            if not vm:
+                return 404, {'error': 'Machine not found'}
+            vm.update(memory=data['memory'], vcpus=data['vcpus'])
+            return 200, True
+        elif endpoint.startswith('cloudapi/machines/') and endpoint.rsplit('/', 1)[-1] in states:
+            vm = self.vms.get(data['machineId'])
+            if not vm:
+                return 404, {'error': 'Machine not found'}
+            vm['status'] = states[endpoint.rsplit('/', 1)[-1]]
+            return 200, True
+        elif endpoint == 'cloudapi/portforwarding/list':
+            return 200, self.forwards.get(data['cloudspaceId'], [])
+        elif endpoint == 'cloudapi/portforwarding/create':
+            forwards = self.forwards[data['cloudspaceId']]
+            if any(int(fwd['publicPort']) == int(data['publicPort']) for fwd in forwards):
+                return 409, {'error': 'Forward to public port already exists'}
+            self.create_forward(data['cloudspaceId'], data['publicIp'], data['publicPort'],
+                                data['machineId'], data['localPort'])
+            return 200, True
+        elif endpoint == 'cloudapi/portforwarding/deleteByPort':
+            forwards = self.forwards[data['cloudspaceId']]
+            forwards[:] = [fwd for fwd in forwards if int(fwd['publicPort']) != int(data['publicPort'])]
+            return 200, True
+        return 404, {'error': 'Unknown endpoint {}'.format(endpoint)}
+
+
+class FakeAPI(ThreadingHTTPServer):
+    """HTTP server answering restmachine and token calls from an Inventory.
+
+    :param inventory: Inventory to serve
+    :type inventory: Inventory
+    :param latency: Seconds every call is delayed, defaults to 0
+    :type latency: float, optional
+    :param error_rate: Fraction of calls answered with a 503, defaults to 0
+    :type error_rate: float, optional
+    """
+    daemon_threads = True
+
+    def __init__(self, inventory, address=('127.0.0.1', 0), latency=0, error_rate=0):
+        super().__init__(address, Handler)
+        self.inventory = inventory
+        self.latency = latency
+        self.error_rate = error_rate
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send headers and body in one segment, avoids delayed-ack stalls on keep-alive
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            return self.reply(503, {'error': 'Injected failure'})
+        if self.path.startswith('/v1/oauth/access_token'):
+            scope = parse_qs(body.decode('utf-8')).get('scope', [''])[0]
+            return self.reply(200, {'access_token': make_jwt({'exp': time.time() + 3600, 'scope': scope})})
+        if not self.path.startswith('/restmachine/'):
+            return self.reply(404, {'error': 'Unknown path'})
+        data = json.loads(body.decode('utf-8')) if body else {}
+        status, result = self.server.inventory.handle(self.path[len('/restmachine/'):], data or {})
+        self.reply(status, result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake OpenvCloud API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--vms', default=100, type=int, help='Amount of VMs to generate')
+    parser.add_argument('--cloudspaces', default=10, type=int, help='Amount of cloudspaces to spread the VMs over')
+    parser.add_argument('--nodes', default=8, type=int, help='Amount of nodes to generate')
+    parser.add_argument('--latency', default=0, type=float, help='Seconds to delay every call')
+    parser.add_argument('--error-rate', default=0, type=float, help='Fraction of calls that fail with a 503')
+    options = parser.parse_args()
+    inventory = Inventory(options.vms, options.cloudspaces, options.nodes)
+    server = FakeAPI(inventory, (options.host, options.port), options.latency, options.error_rate)
+    print('Serving fake OpenvCloud API on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import fnmatch
+
+DEFAULT_IMAGE = '*Ubuntu 16.04*'
+
+
+class ImageCatalog:
+    """Index over the images of an environment by id, name and OS type.
+
+    :param images: Result of the images/list API call
+    :type images: list
+    """
+
+    def __init__(self, images):
+        self.images = list(images)
+        self.by_id = {str(image['id']): image for image in self.images}
+        self.by_name = {}
+        self.by_type = {}
+        for image in self.images:
+            self.by_name.setdefault(image['name'], image)
+            self.by_type.setdefault(image.get('type', '').lower(), []).append(image)
+
+    def find(self, query=None, ostype=None):
+        images = self.by_type.get(ostype.lower(), []) if ostype else self.images
+        if not query:
+            return list(images)
+        if str(query) in self.by_id:
+            image = self.by_id[str(query)]
+            return [image] if image in images else []
+        if query in self.by_name:
+            image = self.by_name[query]
+            return [image] if image in images else []
+        return [image for image in images if fnmatch.fnmatchcase(image['name'], query)]
+
+    def resolve(self, query=None):
+        """Return the first image matching an id, exact name or glob."""
+        query = query or DEFAULT_IMAGE
+        images = self.find(query)
+        if not images:
+            raise LookupError('Could not find image {}'.format(query))
+        return images[0]
@@ -0,0 +1,91 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+hooks = []
+
+
+def add_hook(hook):
+    """Register a callable that receives every span (a dict) once it ended.
+
+    HTTP spans carry kind, endpoint, environment, status, bytes, duration and
+    attempt, other spans (fzf, ssh) carry kind, endpoint and duration.
+    """
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    hooks.remove(hook)
+
+
+def emit(span):
+    for hook in list(hooks):
+        hook(span)
+
+
+@contextmanager
+def timed(kind, endpoint, **fields):
+    if not hooks:
+        yield fields
+        return
+    start = time.time()
+    error = None
+    try:
+        yield fields
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        emit(dict(fields, kind=kind, endpoint=endpoint, start=start,
+                  duration=time.time() - start, error=error))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class Profiler:
+    """Collect spans and print a latency summary per endpoint."""
+
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def __call__(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def summary(self):
+        groups = {}
+        for span in self.spans:
+            groups.setdefault((span['kind'], span['endpoint']), []).append(span['duration'])
+        rows = []
+        for (kind, endpoint), durations in sorted(groups.items(), key=lambda item: -sum(item[1])):
+            rows.append((kind, endpoint, len(durations), percentile(durations, 0.5),
+                         percentile(durations, 0.95), max(durations), sum(durations)))
+        return rows
+
+    def report(self, fd=sys.stderr):
+        fd.write('{:<6} {:<40} {:>6} {:>8} {:>8} {:>8} {:>8}\n'.format('kind', 'endpoint', 'count', 'p50', 'p95', 'max', 'total'))
+        for kind, endpoint, count, p50, p95, maximum, total in self.summary():
+            fd.write('{:<6} {:<40} {:>6} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f}\n'.format(
+                kind, endpoint, count, p50, p95, maximum, total))
+
+
+class TraceWriter:
+    """Write every span as one JSON line to a file."""
+
+    def __init__(self, path):
+        self.fd = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span, default=str) + '\n'
+        with self.lock:
+            self.fd.write(line)
+
+    def close(self):
+        self.fd.close()
@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from .cache import CACHEDIR
+
+DBPATH = os.path.join(CACHEDIR, 'inventory.db')
+
+# Columns per table, the first ones up to the key length identify a record.
+# Every table also has environment, data (the full record as JSON) and hash.
+TABLES = {
+    'accounts': (1, ['id', 'name', 'status']),
+    'cloudspaces': (1, ['id', 'accountId', 'name', 'status', 'externalnetworkip', 'location']),
+    'vms': (1, ['id', 'cloudspaceId', 'name', 'status', 'memory', 'vcpus', 'hostName']),
+    'forwards': (3, ['publicIp', 'publicPort', 'protocol', 'cloudspaceId', 'machineId', 'machineName', 'localIp', 'localPort']),
+    'nodes': (1, ['id', 'name', 'status', 'ipaddr']),
+}
+
+INDEXES = [
+    ('cloudspaces', 'name'), ('cloudspaces', 'externalnetworkip'),
+    ('vms', 'name'), ('vms', 'cloudspaceId'), ('vms', 'status'), ('vms', 'vcpus'),
+    ('forwards', 'machineId'), ('forwards', 'localIp'),
+    ('nodes', 'name'),
+]
+
+
+def record_hash(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def column_value(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return value
+
+
+async def crawl(cli, concurrency=16):
+    """
+    Fetch accounts, cloudspaces, vms, forwards and nodes of the client's environment
+
+    :return: Records per table name
+    :rtype: dict
+    """
+    from .aioclient import AsyncClient
+    async with AsyncClient(cli, concurrency) as acli:
+        accounts, cloudspaces = await asyncio.gather(acli.list_accounts(), acli.list_cloudspaces())
+        listings = await asyncio.gather(
+            *[acli.list_vms(cs) for cs in cloudspaces], *[acli.list_forwards(cs) for cs in cloudspaces])
+        try:
+            await acli.list_nodes()
+            nodes = cli.nodes
+        except Exception:
+            # getNodes is only allowed for admins
+            nodes = None
+    vms = [dict(vm, cloudspaceId=cs['id']) for cs, items in zip(cloudspaces, listings) for vm in items]
+    forwards = [dict(fwd, cloudspaceId=cs['id']) for cs, items in zip(cloudspaces, listings[len(cloudspaces):])
+                for fwd in items]
+    records = {'accounts': accounts, 'cloudspaces': cloudspaces, 'vms': vms, 'forwards': forwards}
+    if nodes is not None:
+        records['nodes'] = nodes
+    return records
+
+
+class InventoryStore:
+    """Local SQLite copy of the inventory of all environments.
+
+    Every record keeps its indexed columns next to the full record as JSON
+    in ``data``. Syncing an environment only rewrites records whose hash
+    changed and drops the ones that disappeared.
+
+    :param path: Database file, defaults to ~/.cache/ovcli/inventory.db
+    :type path: str, optional
+    :param readonly: Open the database read only, defaults to False
+    :type readonly: bool, optional
+    """
+
+    def __init__(self, path=DBPATH, readonly=False):
+        self.path = path
+        if readonly:
+            if not os.path.exists(path):
+                raise LookupError('No inventory yet, run ovcli inventory sync first')
+            self.db = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path)
+            self.create()
+        self.db.row_factory = sqlite3.Row
+
+    def create(self):
+        with self.db:
+            for table, (keylength, columns) in TABLES.items():
+                key = ', '.join(['environment'] + columns[:keylength])
+                self.db.execute('CREATE TABLE IF NOT EXISTS {} (environment TEXT, {}, data TEXT, hash TEXT, '
+                                'PRIMARY KEY ({}))'.format(table, ', '.join(columns), key))
+            for table, column in INDEXES:
+                self.db.execute('CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})'.format(table, column))
+            self.db.execute('CREATE TABLE IF NOT EXISTS syncs (environment TEXT PRIMARY KEY, synced REAL)')
+
+    def close(self):
+        self.db.close()
+
+    def update(self, environment, table, records):
+        """
+        Bring the records of one table of an environment in line with a fresh listing
+
+        :return: Amount of inserted or changed records and amount of removed records
+        :rtype: tuple
+        """
+        keylength, columns = TABLES[table]
+        key = columns[:keylength]
+        existing = {tuple(row)[:-1]: row[-1] for row in self.db.execute(
+            'SELECT {}, hash FROM {} WHERE environment = ?'.format(', '.join(key), table), (environment,))}
+        rows = []
+        for record in records:
+            digest = record_hash(record)
+            values = [column_value(record.get(column)) for column in columns]
+            if existing.pop(tuple(values[:keylength]), None) != digest:
+                rows.append([environment] + values + [json.dumps(record), digest])
+        self.db.executemany('INSERT OR REPLACE INTO {} VALUES ({})'.format(table, ', '.join('?' * (len(columns) + 3))), rows)
+        where = ' AND '.join('{} = ?'.format(column) for column in ['environment'] + key)
+        self.db.executemany('DELETE FROM {} WHERE {}'.format(table, where),
+                            [[environment] + list(values) for values in existing])
+        return len(rows), len(existing)
+
+    def sync(self, environment, records):
+        """Store a crawl of an environment in one transaction, returns the changes per table."""
+        with self.db:
+            changes = {table: self.update(environment, table, items) for table, items in records.items()}
+            self.db.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?)', (environment, time.time()))
+        return changes
+
+    def synced(self, environment=None):
+        """Time of the last sync of an environment, or of the oldest one without environment."""
+        if environment is None:
+            row = self.db.execute('SELECT MIN(synced) FROM syncs').fetchone()
+        else:
+            row = self.db.execute('SELECT synced FROM syncs WHERE environment = ?', (environment,)).fetchone()
+        return row[0] if row else None
+
+    def syncs(self):
+        """Time of the last sync per environment."""
+        return dict(self.db.execute('SELECT environment, synced FROM syncs').fetchall())
+
+    def query(self, sql, params=()):
+        """Run a query, returns the column names and the rows as dicts."""
+        cursor = self.db.execute(sql, params)
+        columns = [description[0] for description in cursor.description or []]
+        return columns, [dict(row) for row in cursor]
+
+
+def table_query(table, where=None):
+    """SELECT of the indexed columns of a table, optionally filtered by a where clause."""
+    sql = 'SELECT environment, {} FROM {}'.format(', '.join(TABLES[table][1]), table)
+    if where:
+        sql += ' WHERE {}'.format(where)
+    return sql
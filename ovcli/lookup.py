@@ -0,0 +1,128 @@
+import fnmatch
+import ipaddress
+import json
+import os
+
+from .cache import CACHEDIR
+from .utils import filter_items, is_pattern
+
+INDEXPATH = os.path.join(CACHEDIR, 'lookup.json')
+
+# Minutes an environment's inventory is trusted before find syncs it again
+DEFAULT_MAX_AGE = 10
+
+
+def is_ip(text):
+    try:
+        ipaddress.ip_address(text)
+        return True
+    except ValueError:
+        return False
+
+
+class LookupIndex:
+    """Hash indexes from ips, public addresses, machine ids and names to inventory records.
+
+    Keys are ``ip:<ip>`` for cloudspace external ips and vm interface ips,
+    ``addr:<ip>:<port>`` for forwards, ``id:<machine id>`` and ``name:<name>``
+    for vms and cloudspaces. The index is built from the inventory and saved
+    next to it, it is only rebuilt when an environment got synced since.
+
+    :param keys: Matches per key
+    :type keys: dict
+    :param syncs: Sync time per environment the index was built from
+    :type syncs: dict
+    """
+
+    def __init__(self, keys, syncs):
+        self.keys = keys
+        self.syncs = syncs
+
+    @classmethod
+    def build(cls, store):
+        keys = {}
+
+        def add(key, entry):
+            keys.setdefault(key, []).append(entry)
+
+        cloudspaces = {}
+        for row in store.query('SELECT environment, id, name, status, externalnetworkip FROM cloudspaces')[1]:
+            cloudspaces[(row['environment'], row['id'])] = row
+            entry = {'environment': row['environment'], 'kind': 'cloudspace', 'cloudspace': row['name'],
+                     'name': row['name'], 'id': row['id'], 'status': row['status'], 'address': row['externalnetworkip']}
+            add('ip:{}'.format(row['externalnetworkip']), entry)
+            add('name:{}'.format(row['name']), entry)
+        vms = {}
+        for row in store.query('SELECT environment, id, cloudspaceId, name, status, data FROM vms')[1]:
+            cloudspace = cloudspaces.get((row['environment'], row['cloudspaceId']), {})
+            entry = {'environment': row['environment'], 'kind': 'vm', 'cloudspace': cloudspace.get('name'),
+                     'name': row['name'], 'id': row['id'], 'status': row['status'], 'address': ''}
+            vms[(row['environment'], row['id'])] = entry
+            add('id:{}'.format(row['id']), entry)
+            add('name:{}'.format(row['name']), entry)
+            for nic in json.loads(row['data']).get('interfaces', []):
+                if nic.get('ipAddress'):
+                    entry['address'] = nic['ipAddress']
+                    add('ip:{}'.format(nic['ipAddress']), entry)
+        for row in store.query('SELECT environment, publicIp, publicPort, cloudspaceId, machineId, machineName, '
+                               'localIp, localPort, protocol FROM forwards')[1]:
+            cloudspace = cloudspaces.get((row['environment'], row['cloudspaceId']), {})
+            vm = vms.get((row['environment'], row['machineId']), {})
+            add('addr:{}:{}'.format(row['publicIp'], row['publicPort']), {
+                'environment': row['environment'], 'kind': 'forward', 'cloudspace': cloudspace.get('name'),
+                'name': row['machineName'], 'id': row['machineId'], 'status': vm.get('status', ''),
+                'address': '{publicIp}:{publicPort} -> {localIp}:{localPort} {protocol}'.format(**row)})
+            # the vm list has no interfaces, forwards tell the ip of the vm
+            if vm and not vm['address']:
+                vm['address'] = row['localIp']
+                add('ip:{}'.format(row['localIp']), vm)
+        return cls(keys, store.syncs())
+
+    @classmethod
+    def load(cls, store, path=INDEXPATH):
+        """Load the saved index, rebuilding and saving it when the inventory changed."""
+        syncs = store.syncs()
+        try:
+            with open(path) as fd:
+                saved = json.load(fd)
+            if saved['syncs'] == syncs:
+                return cls(saved['keys'], saved['syncs'])
+        except (OSError, ValueError, KeyError):
+            pass
+        index = cls.build(store)
+        index.save(path)
+        return index
+
+    def save(self, path=INDEXPATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpname = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmpname, 'w') as fd:
+            json.dump({'syncs': self.syncs, 'keys': self.keys}, fd)
+        os.replace(tmpname, path)
+
+    def find(self, query, mode='substring'):
+        """
+        Find records by ip, ip:port, machine id or name
+
+        :param query: Ip, public ip:port, machine id, name or glob pattern of a name
+        :type query: str
+        :param mode: Match mode for names that do not match exactly, defaults to substring
+        :type mode: str, optional
+        :return: Matching entries
+        :rtype: list
+        """
+        host, _, port = query.rpartition(':')
+        if port.isdigit() and is_ip(host):
+            return self.keys.get('addr:{}:{}'.format(host, port), [])
+        if is_ip(query):
+            return self.keys.get('ip:{}'.format(query), [])
+        if query.isdigit() and 'id:{}'.format(query) in self.keys:
+            return self.keys['id:{}'.format(query)]
+        if 'name:{}'.format(query) in self.keys:
+            return self.keys['name:{}'.format(query)]
+        names = [key[5:] for key in self.keys if key.startswith('name:')]
+        if is_pattern(query, mode):
+            names = fnmatch.filter(names, query)
+        else:
+            names = filter_items(names, query, mode)
+        return [entry for name in sorted(names) for entry in self.keys['name:{}'.format(name)]]
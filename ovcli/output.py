@@ -0,0 +1,196 @@
+import csv
+import json
+import sys
+
+COLORRED = u"\u001b[31m"
+RESET_COLOR = u"\u001b[0m"
+COLORBLUE = u"\u001b[34m"
+COLORGREEN = u"\u001b[32m"
+
+FORMATS = ['text', 'table', 'csv', 'json', 'ndjson']
+
+# Default fields per kind of record
+FIELDS = {
+    'vm': ['name', 'status'],
+    'cloudspace': ['name', 'status', 'externalnetworkip'],
+    'forward': ['machineName', 'publicIp', 'publicPort', 'localIp', 'localPort', 'protocol'],
+    'image': ['id', 'name', 'type'],
+    'match': ['environment', 'kind', 'cloudspace', 'name', 'id', 'status', 'address'],
+}
+
+# Free form lines of the text format
+TEXT = {
+    'vm': "{name} {color}{status}{reset}",
+    'cloudspace': "{name} {status} {externalnetworkip}",
+    'forward': "{machineName} {publicIp}:{publicPort} -> {localIp}:{localPort} {protocol}",
+    'image': "{id} {name} {type}",
+    'match': "{environment} {kind} {cloudspace} {name} {id} {color}{status}{reset} {address}",
+}
+
+# Rows used to size the columns of the table format
+TABLE_SAMPLE = 500
+
+# Characters buffered before they are handed to stdout
+BUFFER_SIZE = 1 << 16
+
+
+def status_color(status):
+    if status == 'RUNNING':
+        return COLORGREEN
+    elif status == 'HALTED':
+        return COLORRED
+    return COLORBLUE
+
+
+class StdoutBuffer:
+    """Collect writes and pass them to the current sys.stdout in large chunks.
+
+    Going through sys.stdout keeps redirections and wrappers of it working.
+    """
+
+    def __init__(self, size=BUFFER_SIZE):
+        self.size = size
+        self.buffer = []
+        self.length = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.length += len(text)
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            sys.stdout.write(''.join(self.buffer))
+            self.buffer = []
+            self.length = 0
+        sys.stdout.flush()
+
+
+class Writer:
+    """Write records in one output format through a single buffered stream.
+
+    Records are never modified, ``extra`` holds columns that are not part of
+    the record such as the environment or cloudspace it belongs to.
+    """
+
+    def __init__(self, kind, fields=None, fd=None):
+        self.kind = kind
+        self.fields = fields
+        self.fd = fd if fd is not None else StdoutBuffer()
+        self.count = 0
+
+    def columns(self, extra):
+        if self.fields:
+            return self.fields
+        return list(extra or ()) + FIELDS[self.kind]
+
+    def row(self, record, extra):
+        return [(extra or {}).get(field, record.get(field, '')) for field in self.columns(extra)]
+
+    def write(self, record, extra=None):
+        self.count += 1
+
+    def close(self):
+        self.fd.flush()
+
+
+class TextWriter(Writer):
+    def write(self, record, extra=None):
+        super().write(record, extra)
+        if self.fields:
+            line = ' '.join(str(value) for value in self.row(record, extra))
+        else:
+            values = dict(record, color=status_color(record.get('status')), reset=RESET_COLOR)
+            values.setdefault('type', '')
+            line = TEXT[self.kind].format(**values)
+            if extra:
+                line = ' '.join(str(value) for value in extra.values()) + ' ' + line
+        self.fd.write(line + '\n')
+
+
+class TableWriter(Writer):
+    def __init__(self, kind, fields=None, fd=None):
+        super().__init__(kind, fields, fd)
+        self.pending = []
+        self.widths = None
+
+    def write(self, record, extra=None):
+        super().write(record, extra)
+        row = [str(value) for value in self.row(record, extra)]
+        if self.widths is not None:
+            return self.emit(row)
+        if not self.pending:
+            self.header = self.columns(extra)
+        self.pending.append(row)
+        if len(self.pending) >= TABLE_SAMPLE:
+            self.flush_pending()
+
+    def flush_pending(self):
+        rows = [self.header] + self.pending
+        self.widths = [max(len(row[idx]) for row in rows) for idx in range(len(self.header))]
+        for row in rows:
+            self.emit(row)
+        self.pending = []
+
+    def emit(self, row):
+        self.fd.write('  '.join(value.ljust(width) for value, width in zip(row, self.widths)).rstrip() + '\n')
+
+    def close(self):
+        if self.widths is None and self.pending:
+            self.flush_pending()
+        super().close()
+
+
+class CSVWriter(Writer):
+    def write(self, record, extra=None):
+        if not self.count:
+            self.csv = csv.writer(self.fd)
+            self.csv.writerow(self.columns(extra))
+        super().write(record, extra)
+        self.csv.writerow(self.row(record, extra))
+
+
+class NDJSONWriter(Writer):
+    def document(self, record, extra):
+        if self.fields:
+            return dict(zip(self.columns(extra), self.row(record, extra)))
+        return dict(extra, **record) if extra else record
+
+    def write(self, record, extra=None):
+        super().write(record, extra)
+        self.fd.write(json.dumps(self.document(record, extra)) + '\n')
+
+
+class JSONWriter(NDJSONWriter):
+    def write(self, record, extra=None):
+        self.fd.write('[\n' if not self.count else ',\n')
+        Writer.write(self, record, extra)
+        self.fd.write(json.dumps(self.document(record, extra)))
+
+    def close(self):
+        self.fd.write('[]\n' if not self.count else '\n]\n')
+        super().close()
+
+
+WRITERS = {
+    'text': TextWriter,
+    'table': TableWriter,
+    'csv': CSVWriter,
+    'json': JSONWriter,
+    'ndjson': NDJSONWriter,
+}
+
+
+def get_writer(kind, output='text', fields=None, fd=None):
+    """
+    Create a writer for records of a kind
+
+    :param kind: One of vm, cloudspace, forward or image
+    :type kind: str
+    :param output: One of text, table, csv, json or ndjson, defaults to text
+    :type output: str, optional
+    :param fields: Fields to write instead of the defaults of the kind
+    :type fields: list, optional
+    """
+    return WRITERS[output or 'text'](kind, fields, fd)
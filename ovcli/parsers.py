@@ -1,8 +1,28 @@
 import argparse
 import os
+from .output import FORMATS
+from .utils import MATCH_MODES
+
+
+def add_watch_arguments(subparser):
+    subparser.add_argument('--watch', action='store_true', help='Keep polling and print changes')
+    subparser.add_argument('--interval', default=2, type=float, help='Seconds between polls while things change, defaults to 2')
+    subparser.add_argument('--max-interval', default=60, type=float, help='Longest wait between polls when nothing changes, defaults to 60')
+    subparser.add_argument('--events', action='store_true', help='Print changes as NDJSON events')
+
 
 parser = argparse.ArgumentParser()
-parser.add_argument("--env", help="Filter for environment", default=os.environ.get("ENV_NAME"))
+parser.add_argument("--env", help="Filter for environment, 'all' or a glob pattern lists across environments", default=os.environ.get("ENV_NAME"))
+parser.add_argument("--match-mode", default="substring", choices=MATCH_MODES,
+                    help="How --env, --name, --cloudspace, ... select items, defaults to substring")
+parser.add_argument("--workers", default=8, type=int, help="Amount of environments to query at once, defaults to 8")
+parser.add_argument("--no-cache", action="store_true", help="Do not read or write the response cache")
+parser.add_argument("--refresh", action="store_true", help="Ignore cached responses but update the cache")
+parser.add_argument("--output", default="text", choices=FORMATS, help="Output format of list commands, defaults to text")
+parser.add_argument("--fields", default=None, help="Comma separated fields to output instead of the defaults")
+parser.add_argument("--profile", action="store_true", help="Print a latency summary per endpoint at exit")
+parser.add_argument("--trace-file", default=None, help="Append every timed call as a JSON line to this file")
+parser.add_argument("--no-agent", action="store_true", help="Do not forward list commands to a running ovcli agent")
 subparsers = parser.add_subparsers(dest="group")
 
 vmgroup = subparsers.add_parser("vm")
@@ -10,22 +30,57 @@ vmsubs = vmgroup.add_subparsers(dest="vmaction")
 vmcreate = vmsubs.add_parser("create")
 vmlist = vmsubs.add_parser("list")
 vmlist.add_argument('--cloudspace', default=None, help='Preselect cloudspace')
+add_watch_arguments(vmlist)
 
 vmcreate.add_argument('--name', default=None)
 vmcreate.add_argument('--memory', default=1024, type=int, help='VM memory in MiB defaults to 1024')
 vmcreate.add_argument('--vcpus', default=1, type=int, help='VM vcpus defaults to 1')
 vmcreate.add_argument('--cloudspace', default=None, help='Preselect cloudspace')
+vmcreate.add_argument('--image', default=None, help='Image id, name or glob pattern, defaults to Ubuntu 16.04')
+vmcreate.add_argument('--count', default=1, type=int, help='Amount of VMs to create, defaults to 1')
+vmcreate.add_argument('--name-template', default=None, help='Name for each VM when using --count, {i} is replaced by the VM number')
+vmcreate.add_argument('--parallel', default=8, type=int, help='Amount of VMs to create at once, defaults to 8')
+vmcreate.add_argument('--wait', action='store_true', help='Wait until the VMs are running')
+vmcreate.add_argument('--timeout', default=300, type=int, help='Seconds to wait, defaults to 300')
 
 vmdelete = vmsubs.add_parser("delete")
 vmdelete.add_argument('--name', default=None)
 vmdelete.add_argument('--cloudspace', default=None, help='Preselect cloudspace')
 
+image = subparsers.add_parser("image")
+imagesubs = image.add_subparsers(dest="imageaction")
+imagelist = imagesubs.add_parser("list")
+imagelist.add_argument('--name', default=None, help='Filter on image id, name or glob pattern')
+imagelist.add_argument('--type', default=None, help='Filter on OS type e.g. Linux or Windows')
+
+vmaction = vmsubs.add_parser("action")
+vmaction.add_argument('action', choices=['start', 'stop', 'reboot', 'pause', 'resume', 'delete'])
+vmaction.add_argument('--name', default=None)
+vmaction.add_argument('--cloudspace', default=None, help='Preselect cloudspace')
+vmaction.add_argument('--match', default=None, help='Run the action on every VM whose name matches this glob pattern')
+vmaction.add_argument('--all-cloudspaces', action='store_true', help='Select VMs in all cloudspaces')
+vmaction.add_argument('--status', default=[], action='append', help='Only select VMs with this status, can be repeated')
+vmaction.add_argument('--parallel', default=8, type=int, help='Amount of actions to run at once, defaults to 8')
+vmaction.add_argument('--rate', default=None, type=float, help='Maximum amount of actions started per second')
+vmaction.add_argument('--dry-run', action='store_true', help='Only print the VMs that would be selected')
+vmaction.add_argument('--yes', action='store_true', help='Do not ask for confirmation when deleting')
+vmaction.add_argument('--wait', action='store_true', help='Wait until the VM reached its new status')
+vmaction.add_argument('--timeout', default=300, type=int, help='Seconds to wait, defaults to 300')
+
 console = subparsers.add_parser('zaccess')
 console.add_argument('--node', default=None, help='Preselect node to connect to')
+consolesubs = console.add_subparsers(dest='zaction')
+consoleexec = consolesubs.add_parser('exec', help='Run a command on several nodes at once')
+consoleexec.add_argument('--node', default=argparse.SUPPRESS, help='Glob pattern or filter of the nodes to run on, defaults to the zaccess --node or all nodes')
+consoleexec.add_argument('--parallel', default=16, type=int, help='Amount of nodes to run on at once, defaults to 16')
+consoleexec.add_argument('--timeout', default=None, type=float, help='Seconds after which the command is killed on a node')
+consoleexec.add_argument('--json', default=None, help='Write the exit code and output per node as JSON to this file, - for stdout')
+consoleexec.add_argument('command', nargs='+', help='Command to run, put it after -- when it has options')
 
 cloudspace = subparsers.add_parser("cloudspace")
 cssubs = cloudspace.add_subparsers(dest="csaction")
-cssubs.add_parser("list")
+cslist = cssubs.add_parser("list")
+add_watch_arguments(cslist)
 cscreate = cssubs.add_parser("create")
 cscreate.add_argument('--name', default=None)
 cscreate.add_argument('--account', default=None)
@@ -39,6 +94,7 @@ fwdsubs = forwards.add_subparsers(dest="fwdaction")
 
 fwdlist = fwdsubs.add_parser("list")
 fwdlist.add_argument('--cloudspace', default=None, help='Preselect cloudspace')
+add_watch_arguments(fwdlist)
 
 fwdcreate = fwdsubs.add_parser("create")
 fwdcreate.add_argument('--machine', default=None, help='Preselect vm')
@@ -49,3 +105,32 @@ fwdcreate.add_argument('--cloudspace', default=None, help='Preselect cloudspace'
 fwddelete = fwdsubs.add_parser("delete")
 fwddelete.add_argument('--publicport', default=None, help='Choose public port', required=True)
 fwddelete.add_argument('--cloudspace', default=None, help='Preselect cloudspace')
+
+apply = subparsers.add_parser('apply', help='Create, update and delete what is needed to match a stack file')
+apply.add_argument('-f', '--file', required=True, help='Stack YAML file, - for stdin')
+apply.add_argument('--parallel', default=8, type=int, help='Amount of changes to run at once, defaults to 8')
+apply.add_argument('--yes', action='store_true', help='Do not ask for confirmation when the plan deletes things')
+plan = subparsers.add_parser('plan', help='Show what apply would change')
+plan.add_argument('-f', '--file', required=True, help='Stack YAML file, - for stdin')
+
+agent = subparsers.add_parser('agent', help='Resident process answering list commands of other ovcli calls')
+agent.add_argument('agentaction', nargs='?', default='status', choices=['run', 'start', 'stop', 'status'],
+                   help='run in the foreground, start in the background, stop or show the status, defaults to status')
+
+inventory = subparsers.add_parser('inventory')
+inventorysubs = inventory.add_subparsers(dest='inventoryaction')
+inventorysync = inventorysubs.add_parser('sync', help='Crawl environments into the local inventory, --env defaults to all')
+
+query = subparsers.add_parser('query', help='Query the local inventory')
+query.add_argument('sql', help='SQL query or one of the tables accounts, cloudspaces, vms, forwards or nodes')
+query.add_argument('--where', default=None, help='Where clause when querying a table e.g. "vcpus > 8"')
+
+find = subparsers.add_parser('find', help='Find VMs, cloudspaces and forwards in the local inventory')
+find.add_argument('query', help='Ip, public ip:port, machine id, name or glob pattern of a name')
+find.add_argument('--max-age', default=None, type=float,
+                  help='Sync environments whose inventory is older than this many minutes first, defaults to 10')
+
+shellparser = argparse.ArgumentParser(prog='ovcsh', description='Interactive shell, or run paths like env/cloudspace/foo/vm/bar/reboot')
+shellparser.add_argument('-c', '--command', default=[], action='append', help='Path to run instead of prompting, can be repeated')
+shellparser.add_argument('--yes', action='store_true', help='Answer yes to every confirmation')
+shellparser.add_argument('script', nargs='?', default=None, help='File with one path per line, - or a non-terminal stdin reads stdin')
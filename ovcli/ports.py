@@ -0,0 +1,56 @@
+import threading
+
+DEFAULT_RANGE = (3500, 65535)
+
+
+def parse_range(text):
+    start, _, end = text.partition('-')
+    return int(start), int(end or start)
+
+
+class PortAllocator:
+    """Hands out free public ports of one cloudspace.
+
+    Used ports are kept in a set and allocation resumes where the previous
+    one stopped, so handing out ports does not rescan the forwards. Allocated
+    ports stay reserved until they are released, which keeps concurrent
+    creates in one process from picking the same port.
+
+    :param usedports: Public ports already forwarded in the cloudspace
+    :type usedports: iterable
+    :param portrange: Inclusive (start, end) range to allocate from
+    :type portrange: tuple, optional
+    """
+
+    def __init__(self, usedports, portrange=DEFAULT_RANGE):
+        self.start, self.end = portrange
+        self.used = set(usedports)
+        self.position = self.start
+        self.lock = threading.Lock()
+
+    def allocate(self, count=1):
+        ports = []
+        with self.lock:
+            port = self.position
+            for _ in range(self.end - self.start + 1):
+                if len(ports) == count:
+                    break
+                if port not in self.used:
+                    self.used.add(port)
+                    ports.append(port)
+                port = port + 1 if port < self.end else self.start
+            self.position = port
+            if len(ports) < count:
+                self.used.difference_update(ports)
+                raise LookupError('Not enough free public ports in range {}-{}'.format(self.start, self.end))
+        return ports
+
+    def mark_used(self, port):
+        with self.lock:
+            self.used.add(int(port))
+
+    def release(self, port):
+        with self.lock:
+            self.used.discard(int(port))
+            if self.start <= port < self.position:
+                self.position = port
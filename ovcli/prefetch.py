@@ -0,0 +1,114 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Entry:
+    def __init__(self, loader):
+        self.loader = loader
+        self.value = None
+        self.loaded = 0
+        self.used = time.time()
+        self.future = None
+        self.ready = threading.Event()
+
+
+class Prefetcher:
+    """Loads listings on a background pool and keeps them fresh.
+
+    Values are identified by a key (e.g. ``('vms', environment, cloudspaceid)``).
+    Once a value is loaded it is served right away, a timer reloads values
+    older than ``interval`` seconds in the background. Values that were not
+    read for ``idle`` seconds are dropped instead of reloaded.
+
+    :param workers: Amount of listings loaded at once, defaults to 4
+    :type workers: int, optional
+    :param interval: Seconds after which a listing is reloaded, defaults to 60
+    :type interval: int, optional
+    :param idle: Seconds without reads after which a listing is dropped, defaults to 3 intervals
+    :type idle: int, optional
+    """
+
+    def __init__(self, workers=4, interval=60, idle=None):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.interval = interval
+        self.idle = idle if idle is not None else 3 * interval
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self._refresh_loop, daemon=True)
+        self.timer.start()
+
+    def _load(self, key, entry):
+        try:
+            value = entry.loader()
+        except Exception:
+            return
+        finally:
+            with self.lock:
+                entry.future = None
+        with self.lock:
+            entry.value = value
+            entry.loaded = time.time()
+        entry.ready.set()
+
+    def _submit(self, key, entry):
+        # caller holds self.lock
+        if entry.future is None:
+            entry.future = self.executor.submit(self._load, key, entry)
+        return entry.future
+
+    def prefetch(self, key, loader):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = Entry(loader)
+                self._submit(key, entry)
+            entry.used = time.time()
+        return entry
+
+    def get(self, key, loader):
+        """Return the loaded value, only waits when it was never loaded."""
+        entry = self.prefetch(key, loader)
+        if not entry.ready.is_set():
+            with self.lock:
+                future = entry.future
+            if future is not None:
+                future.result()
+            if not entry.ready.is_set():
+                # background load failed, load in the foreground to surface the error
+                self.put(key, loader(), loader)
+        return entry.value
+
+    def peek(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry.used = time.time()
+            return entry.value
+
+    def put(self, key, value, loader=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = Entry(loader)
+            entry.value = value
+            entry.loaded = entry.used = time.time()
+        entry.ready.set()
+
+    def _refresh_loop(self):
+        while not self.stopped.wait(min(self.interval, 5)):
+            now = time.time()
+            with self.lock:
+                for key, entry in list(self.entries.items()):
+                    if entry.used + self.idle < now:
+                        # nobody looked at it lately, load it again when it is needed
+                        if entry.future is None:
+                            del self.entries[key]
+                    elif entry.loader and entry.ready.is_set() and entry.loaded + self.interval < now:
+                        self._submit(key, entry)
+
+    def stop(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False)
@@ -1,17 +1,29 @@
 from prompt_toolkit import PromptSession
 from prompt_toolkit.completion import Completion
+from prompt_toolkit.document import Document
 from prompt_toolkit.eventloop.async_generator import AsyncGeneratorItem
 from prompt_toolkit.validation import Validator, ValidationError
 from prompt_toolkit.shortcuts import yes_no_dialog
 from prompt_toolkit.styles import Style
-import yaml
 
-from .client import Client
+import logging
+import sys
+import threading
+
+from .client import ACTION_STATES, Client
+from .completion import CompletionIndex
+from .prefetch import Prefetcher
+
+
+logger = logging.getLogger('ovcsh')
 
 
 def log(text):
-    with open("/tmp/ovc.log", "a+") as fd:
-        fd.writelines([str(text)])
+    if not logger.handlers:
+        logger.addHandler(logging.FileHandler("/tmp/ovc.log"))
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+    logger.debug(str(text))
 
 style = Style.from_dict({
     # User input (default text).
@@ -42,10 +54,27 @@ def menu(text):
 class Component:
     def __init__(self, shell):
         self.shell = shell
+        self._index = None
 
     def completer(self):
         yield
 
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = CompletionIndex(self.completer())
+        return self._index
+
+    def refresh_index(self):
+        if self._index is not None:
+            self._index.update(self.completer())
+
+    def sync(self):
+        pass
+
+    def resolve(self, text):
+        return text
+
     def update_components(self, result):
         if result == "..":
             self.shell.components.pop()
@@ -61,11 +90,8 @@ class Component:
         text = document.current_line_before_cursor
         if not text:
             return
-        for item in self.completer():
-            if not isinstance(item, Completion):
-                item = Completion(item)
-            if item.text == text:
-                return
+        if text in self.index:
+            return
         if text in ["/", ".."]:
             return
         raise ValidationError(message="Invalid action")
@@ -74,6 +100,8 @@ class EnvSubComponent(Component):
     def __init__(self, shell, environment):
         super().__init__(shell)
         self.shell.client.set_environment(environment)
+        self.shell.prefetch('cloudspaces')
+        self.shell.prefetch('nodes')
 
     def completer(self):
         yield menu("console")
@@ -102,7 +130,7 @@ class CloudSpaceComponent(Component):
         if super().update_components(result):
             return
         if result == "delete":
-            if yes_no_dialog("Confirm", "Are you sure you want to delete cloudspace {}".format(self.cloudspace["name"])):
+            if self.shell.confirm("Are you sure you want to delete cloudspace {}".format(self.cloudspace["name"])):
                 self.shell.client.delete_cloudspace(self.cloudspace)
                 super().update_components("..")
         elif result == "vm":
@@ -130,16 +158,32 @@ class VMComponent(Component):
         super().__init__(shell)
         self.vm = vm
 
+    @property
+    def vm(self):
+        return self._vm
+
+    @vm.setter
+    def vm(self, vm):
+        self._vm = vm
+        self.refresh_index()
+
     def update_components(self, result):
         if super().update_components(result):
             return
         if result == "delete":
-            if yes_no_dialog("Confirm", "Are you sure you want to delete vm {}".format(self.vm["name"])):
+            if self.shell.confirm("Are you sure you want to delete vm {}".format(self.vm["name"])):
                 self.shell.client.delete_vm_by_id(self.vm['id'])
+                self.store_vm(None)
                 super().update_components("..")
         elif result in ["start", "reboot", "pause", "resume", "stop"]:
             self.shell.client.vm_action(result, self.vm['id'])
+            cloudspace = self.shell.components[3].cloudspace
+            try:
+                self.shell.client.wait_for_state([dict(self.vm, cloudspaceId=cloudspace['id'])], ACTION_STATES[result], 120)
+            except TimeoutError as error:
+                print(error)
             self.vm = self.shell.client.vm_action('get', self.vm['id'])
+            self.store_vm(self.vm)
         elif result.startswith("createforward"):
             segments = result.split()
             if len(segments) not in [2, 3]:
@@ -158,8 +202,15 @@ class VMComponent(Component):
             self.shell.client.create_forward(self.shell.components[3].cloudspace, self.vm['name'], publicport, privateport)
         elif result == "print":
             self.vm = self.shell.client.vm_action('get', self.vm['id'])
+            import yaml
             print(yaml.safe_dump(self.vm, default_flow_style=False))
 
+    def store_vm(self, vm):
+        # keep the listing in line, later commands validate against its status
+        cloudspace = self.shell.components[3].cloudspace
+        vms = [vm if item['id'] == self.vm['id'] else item for item in self.shell.listing('vms', cloudspace)]
+        self.shell.store('vms', [item for item in vms if item is not None], cloudspace)
+
     def completer(self):
         if self.vm['status'] == 'RUNNING':
             yield action("stop")
@@ -183,7 +234,24 @@ class VMComponent(Component):
 class CloudSpaceListComponent(Component):
     def __init__(self, shell):
         super().__init__(shell)
-        self.cloudspaces = self.shell.client.list_cloudspaces()
+        self.cloudspaces = self.shell.listing('cloudspaces')
+        for cloudspace in self.cloudspaces:
+            self.shell.prefetch('vms', cloudspace)
+            self.shell.prefetch('forwards', cloudspace)
+
+    def sync(self):
+        cloudspaces = self.shell.listing('cloudspaces')
+        if cloudspaces is not self.cloudspaces:
+            self.cloudspaces = cloudspaces
+
+    @property
+    def cloudspaces(self):
+        return self._cloudspaces
+
+    @cloudspaces.setter
+    def cloudspaces(self, cloudspaces):
+        self._cloudspaces = cloudspaces
+        self.refresh_index()
 
     def completer(self):
         yield action("create")
@@ -201,6 +269,7 @@ class CloudSpaceListComponent(Component):
             name = self.shell.prompt("Name: ")
             self.shell.client.create_cloudspace(name, None, None)
             self.cloudspaces = self.shell.client.list_cloudspaces()
+            self.shell.store('cloudspaces', self.cloudspaces)
             result = name
         for cs in self.cloudspaces:
             if cs["name"] == result:
@@ -219,22 +288,39 @@ class ForwardListCompontent(Component):
     def __init__(self, shell, cloudspace):
         super().__init__(shell)
         self.cloudspace = cloudspace
-        self.forwards = self.shell.client.list_forwards(cloudspace)
+        self.forwards = self.shell.listing('forwards', cloudspace)
+
+    def sync(self):
+        forwards = self.shell.listing('forwards', self.cloudspace)
+        if forwards is not self.forwards:
+            self.forwards = forwards
+
+    @property
+    def forwards(self):
+        return self._forwards
+
+    @forwards.setter
+    def forwards(self, forwards):
+        self._forwards = forwards
+        self.refresh_index()
 
     def completer(self):
         yield action("print")
         yield deleteaction("delete")
+        for fwd in self.forwards:
+            yield deleteaction("delete {}".format(fwd['publicPort']))
 
     def update_components(self, result):
         if super().update_components(result):
             return
         if result == "print":
             self.forwards = self.shell.client.list_forwards(self.cloudspace)
+            self.shell.store('forwards', self.forwards, self.cloudspace)
             self.shell.client.print_forwards(self.cloudspace, self.forwards)
         elif result.startswith("delete "):
             pubport = result.split()[-1]
             if pubport.isdigit():
-                if yes_no_dialog("Confirm", "Are you sure you want to delete forward {}".format(pubport)):
+                if self.shell.confirm("Are you sure you want to delete forward {}".format(pubport)):
                     self.shell.client.delete_forward(self.cloudspace, int(pubport))
 
     def validate(self, document):
@@ -256,7 +342,21 @@ class VMListComponent(Component):
     def __init__(self, shell, cloudspace):
         super().__init__(shell)
         self.cloudspace = cloudspace
-        self.vms = self.shell.client.list_vms(cloudspace)
+        self.vms = self.shell.listing('vms', cloudspace)
+
+    def sync(self):
+        vms = self.shell.listing('vms', self.cloudspace)
+        if vms is not self.vms:
+            self.vms = vms
+
+    @property
+    def vms(self):
+        return self._vms
+
+    @vms.setter
+    def vms(self, vms):
+        self._vms = vms
+        self.refresh_index()
 
     def completer(self):
         yield action("create")
@@ -274,6 +374,7 @@ class VMListComponent(Component):
             return
         elif result == "print":
             self.vms = self.shell.client.list_vms(self.cloudspace)
+            self.shell.store('vms', self.vms, self.cloudspace)
             self.shell.client.print_vms(self.cloudspace, self.vms)
             return
         for vm in self.vms:
@@ -291,7 +392,8 @@ class VMListComponent(Component):
 class ConsoleComponent(Component):
     def __init__(self, shell):
         super().__init__(shell)
-        self.nodes = self.shell.client.list_nodes()
+        self.shell.client.nodes = self.shell.listing('nodes')
+        self.nodes = [node['name'] for node in self.shell.client.nodes]
 
     def completer(self):
         for node in self.nodes:
@@ -315,6 +417,16 @@ class RootComponent(Component):
         for env in self.shell.client.environments:
             yield env
 
+    def resolve(self, text):
+        # scripts may use the short name that is shown in the prompt
+        if text not in self.shell.client.environments:
+            matches = [env for env in self.shell.client.environments if env.split(".")[-1] == text]
+            if len(matches) > 1:
+                raise ValidationError(message="Ambiguous environment {}, use one of {}".format(text, ", ".join(matches)))
+            if matches:
+                return matches[0]
+        return text
+
     def update_components(self, result):
         if result in self.shell.client.environments:
             self.shell.components.append(EnvSubComponent(self.shell, result))
@@ -323,24 +435,72 @@ class RootComponent(Component):
         return ""
 
 class Shell(Validator):
-    def __init__(self, client):
+    """Interactive shell over the component tree, also drives it from scripts.
+
+    :param client: Client to use
+    :type client: Client
+    :param yes: Answer yes to every confirmation, defaults to False
+    :type yes: bool, optional
+    :param batch: Run commands from a script: no prompts, no background
+        listing of other cloudspaces and listings are never reloaded
+    :type batch: bool, optional
+    """
+
+    def __init__(self, client, yes=False, batch=False):
         self.client = client
-        self._prompt = PromptSession()
+        self.yes = yes
+        self.batch = batch
+        self._prompt = None
         self.mode = None
         self.cloudspace = None
         self.components = [RootComponent(self)]
+        self.prefetcher = Prefetcher(interval=float('inf') if batch else 60)
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def env_client(self, environment):
+        with self.lock:
+            client = self.clients.get(environment)
+            if client is None:
+                client = self.clients[environment] = Client(self.client.tokens, self.client.transport)
+        if client.environment is None:
+            client.set_environment(environment)
+        return client
+
+    def _key(self, kind, cloudspace=None):
+        return (kind, self.client.environment, cloudspace['id'] if cloudspace else None)
+
+    def _loader(self, kind, cloudspace=None):
+        environment = self.client.environment
+
+        def load():
+            client = self.env_client(environment)
+            if kind == 'cloudspaces':
+                return client.list_cloudspaces()
+            elif kind == 'vms':
+                return client.list_vms(cloudspace)
+            elif kind == 'forwards':
+                return client.list_forwards(cloudspace)
+            elif kind == 'nodes':
+                client.list_nodes()
+                return client.nodes
+        return load
+
+    def prefetch(self, kind, cloudspace=None):
+        if self.batch:
+            return
+        self.prefetcher.prefetch(self._key(kind, cloudspace), self._loader(kind, cloudspace))
+
+    def listing(self, kind, cloudspace=None):
+        return self.prefetcher.get(self._key(kind, cloudspace), self._loader(kind, cloudspace))
+
+    def store(self, kind, value, cloudspace=None):
+        self.prefetcher.put(self._key(kind, cloudspace), value, self._loader(kind, cloudspace))
 
     def get_completions_async(self, document, complete_event):
-        for item in self.components[-1].completer():
-            text = document.current_line_before_cursor
-            if not item:
-                continue
-            if isinstance(item, Completion):
-                item.start_position = -len(text)
-            else:
-                item = Completion(item, -len(text))
-            if text in item.text:
-                yield AsyncGeneratorItem(item)
+        text = document.current_line_before_cursor
+        for item in self.components[-1].index.complete(text):
+            yield AsyncGeneratorItem(item)
 
     def validate(self, document):
         return self.components[-1].validate(document)
@@ -354,18 +514,81 @@ class Shell(Validator):
                 message.append(component.message())
                 message.append(seperator)
             message[-1] = ('class:default', " > ")
+            component.sync()
             result = self.prompt(message)
             component.update_components(result)
 
 
     def prompt(self, msg):
+        if self.batch:
+            raise ValueError('Interactive input is not available in scripts')
+        if self._prompt is None:
+            self._prompt = PromptSession()
         return self._prompt.prompt(msg, completer=self, style=style, validator=self)
 
+    def confirm(self, message):
+        if self.yes:
+            return True
+        if self.batch:
+            print("{}? Skipped, pass --yes to confirm".format(message), file=sys.stderr)
+            return False
+        return yes_no_dialog("Confirm", message)
+
+    def run_path(self, path):
+        """
+        Run a path like env/cloudspace/foo/vm/bar/reboot from the root
+
+        Every segment is validated like typed input before it is applied.
+
+        :raises ValidationError: When a segment is not valid where it is used
+        """
+        self.components = self.components[:1]
+        for segment in path.split("/"):
+            segment = segment.strip()
+            if not segment:
+                continue
+            component = self.components[-1]
+            component.sync()
+            segment = component.resolve(segment)
+            component.validate(Document(segment))
+            component.update_components(segment)
+
+    def run_script(self, lines):
+        """Run paths line by line, blank lines and # comments are skipped, stops at the first error."""
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                self.run_path(line)
+            except ValidationError as error:
+                raise ValueError("line {}: {}: {}".format(number, line, error.message))
+            except Exception as error:
+                raise ValueError("line {}: {}: {}".format(number, line, error))
+
         
 def main():
+    from .parsers import shellparser
+    options = shellparser.parse_args()
     cl = Client()
+    if options.command or options.script or not sys.stdin.isatty():
+        if options.command:
+            lines = options.command
+        elif options.script and options.script != "-":
+            with open(options.script) as fd:
+                lines = fd.read().splitlines()
+        else:
+            lines = sys.stdin.read().splitlines()
+        shell = Shell(cl, options.yes, batch=True)
+        try:
+            shell.run_script(lines)
+        except ValueError as error:
+            sys.exit(str(error))
+        finally:
+            shell.prefetcher.stop()
+        return
     try:
-        Shell(cl).make_prompt()
+        Shell(cl, options.yes).make_prompt()
     except (EOFError, KeyboardInterrupt):
         pass
 
@@ -0,0 +1,311 @@
+import sys
+import threading
+
+SYMBOLS = {'create': '+', 'update': '~', 'delete': '-'}
+
+
+class Change:
+    """One step of a plan, runs func once the changes it depends on succeeded.
+
+    :param action: create, update or delete
+    :type action: str
+    :param kind: cloudspace, vm or forward
+    :type kind: str
+    :param deps: Keys of changes that have to succeed first, keys not in the plan are ignored
+    :type deps: list, optional
+    """
+
+    def __init__(self, action, kind, cloudspace, name, detail='', func=None, deps=()):
+        self.action = action
+        self.kind = kind
+        self.cloudspace = cloudspace
+        self.name = name
+        self.detail = detail
+        self.func = func
+        self.deps = list(deps)
+
+    @property
+    def key(self):
+        return change_key(self.kind, self.cloudspace, self.name)
+
+    def __str__(self):
+        target = self.name if self.kind == 'cloudspace' else '{}/{}'.format(self.cloudspace, self.name)
+        line = '{} {} {}'.format(SYMBOLS[self.action], self.kind, target)
+        return '{} ({})'.format(line, self.detail) if self.detail else line
+
+
+def change_key(kind, cloudspace, name):
+    return '{}:{}/{}'.format(kind, cloudspace, name)
+
+
+def parse_forward(forward):
+    """A forward is a local port, 'public:local' or a dict with local and public."""
+    if isinstance(forward, dict):
+        public = forward.get('public')
+        return {'local': int(forward['local']), 'public': int(public) if public else None}
+    public, _, local = str(forward).rpartition(':')
+    return {'local': int(local), 'public': int(public) if public else None}
+
+
+def load_stack(path):
+    """
+    Read and normalize a stack file
+
+    ::
+
+        environment: be-g8-3
+        cloudspaces:
+          - name: web
+            account: myaccount
+            prune: true
+            vms:
+              - name: web-{i}
+                count: 20
+                memory: 2048
+                vcpus: 2
+                image: "*Ubuntu 18.04*"
+                forwards: [22, "8080:80"]
+
+    :param path: YAML file, - for stdin
+    :type path: str
+    :return: Stack with every vm expanded by its count
+    :rtype: dict
+    """
+    import yaml
+    if path == '-':
+        spec = yaml.safe_load(sys.stdin)
+    else:
+        with open(path) as fd:
+            spec = yaml.safe_load(fd)
+    spec = spec or {}
+    cloudspaces = []
+    for cloudspace in spec.get('cloudspaces', []):
+        vms = {}
+        publicports = set()
+        for vm in cloudspace.get('vms', []):
+            count = int(vm.get('count', 1))
+            names = [vm['name'].format(i=idx) for idx in range(1, count + 1)] if '{i}' in vm['name'] else [vm['name']]
+            if len(names) != count:
+                raise ValueError('VM {} has a count but no {{i}} in its name'.format(vm['name']))
+            for name in names:
+                if name in vms:
+                    raise ValueError('VM {} is defined twice in cloudspace {}'.format(name, cloudspace['name']))
+                vms[name] = {
+                    'name': name,
+                    'memory': int(vm.get('memory', 1024)),
+                    'vcpus': int(vm.get('vcpus', 1)),
+                    'image': vm.get('image'),
+                    'forwards': [parse_forward(forward) for forward in vm.get('forwards', [])],
+                }
+                localports = [forward['local'] for forward in vms[name]['forwards']]
+                if len(set(localports)) != len(localports):
+                    raise ValueError('VM {} forwards a local port twice in cloudspace {}'.format(name, cloudspace['name']))
+                for forward in vms[name]['forwards']:
+                    if forward['public'] in publicports:
+                        raise ValueError('Public port {} is used twice in cloudspace {}'.format(
+                            forward['public'], cloudspace['name']))
+                    if forward['public']:
+                        publicports.add(forward['public'])
+        cloudspaces.append({
+            'name': cloudspace['name'],
+            'account': cloudspace.get('account'),
+            'type': cloudspace.get('type'),
+            'prune': bool(cloudspace.get('prune', False)),
+            'vms': list(vms.values()),
+        })
+    return {'environment': spec.get('environment'), 'cloudspaces': cloudspaces}
+
+
+class StackPlanner:
+    """Diff a stack against the current state of an environment.
+
+    The current state is fetched once: the cloudspace list plus the vms and
+    forwards of every existing cloudspace of the stack, concurrently. The
+    resulting changes carry the calls that apply them and their
+    dependencies: a cloudspace before its vms, a vm before its forwards.
+
+    :param client: Client with the environment selected
+    :type client: Client
+    :param stack: Stack as returned by load_stack
+    :type stack: dict
+    """
+
+    def __init__(self, client, stack, workers=8):
+        from .utils import fanout
+        self.client = client
+        self.stack = stack
+        self.lock = threading.Lock()
+        self.cloudspaces = {cs['name']: cs for cs in client.api('cloudapi/cloudspaces/list', cached=False)}
+        existing = [self.cloudspaces[cs['name']] for cs in stack['cloudspaces'] if cs['name'] in self.cloudspaces]
+        self.vms = {}
+        self.forwards = {}
+        # public ports the stack asks for, kept away from automatic allocation
+        self.reserved = {}
+        listings = fanout(lambda cs: (client.list_vms(cs, cached=False), client.api(
+            'cloudapi/portforwarding/list', {'cloudspaceId': cs['id']}, cached=False)), existing, workers)
+        for cloudspace, result, error in listings:
+            if error is not None:
+                raise error
+            vms, forwards = result
+            self.vms[cloudspace['name']] = {vm['name']: vm for vm in vms}
+            self.forwards[cloudspace['name']] = forwards
+
+    def plan(self):
+        changes = []
+        for cloudspace in self.stack['cloudspaces']:
+            changes += self.plan_cloudspace(cloudspace)
+        return changes
+
+    def plan_cloudspace(self, spec):
+        name = spec['name']
+        changes = []
+        cskey = change_key('cloudspace', name, name)
+        if name not in self.cloudspaces:
+            if not spec['account']:
+                raise ValueError('Cloudspace {} does not exist yet, it needs an account to be created'.format(name))
+            # select the account here, changes run on threads that cannot prompt
+            account = self.client.select_account(spec['account'])
+            changes.append(Change('create', 'cloudspace', name, name, 'account {}'.format(account['name']),
+                                  lambda: self.create_cloudspace(spec, account)))
+        current = self.vms.get(name, {})
+        wanted = {vm['name'] for vm in spec['vms']}
+        for vm in spec['vms']:
+            existing = current.get(vm['name'])
+            if existing is None:
+                changes.append(Change('create', 'vm', name, vm['name'],
+                                      '{memory} MiB, {vcpus} vcpus'.format(**vm), self.creator(name, vm), [cskey]))
+                continue
+            differences = ['{} {} -> {}'.format(field, existing[field], vm[field]) for field in ('memory', 'vcpus')
+                           if existing.get(field) is not None and existing[field] != vm[field]]
+            if differences:
+                changes.append(Change('update', 'vm', name, vm['name'], ', '.join(differences),
+                                      self.resizer(existing, vm)))
+        if spec['prune']:
+            for vmname, existing in sorted(current.items()):
+                if vmname not in wanted:
+                    changes.append(Change('delete', 'vm', name, vmname, existing.get('status', ''),
+                                          self.deleter(existing)))
+        changes += self.plan_forwards(spec, wanted)
+        return changes
+
+    def plan_forwards(self, spec, wanted):
+        name = spec['name']
+        current = list(self.forwards.get(name, []))
+        deletes = []
+        creates = []
+        for vm in spec['vms']:
+            for forward in vm['forwards']:
+                match = None
+                for existing in current:
+                    if existing['machineName'] == vm['name'] and int(existing['localPort']) == forward['local'] and \
+                            (forward['public'] is None or int(existing['publicPort']) == forward['public']):
+                        match = existing
+                        break
+                if match is not None:
+                    current.remove(match)
+                    continue
+                if forward['public']:
+                    self.reserved.setdefault(name, set()).add(forward['public'])
+                label = '{}:{} -> {}'.format(vm['name'], forward['public'] or '*', forward['local'])
+                creates.append(Change('create', 'forward', name, label, '',
+                                      self.forwarder(name, vm['name'], forward), [change_key('vm', name, vm['name'])]))
+        if spec['prune']:
+            # forwards of vms that get deleted disappear with the vm
+            for existing in current:
+                if existing['machineName'] in wanted:
+                    label = '{machineName}:{publicPort} -> {localPort}'.format(**existing)
+                    deletes.append(Change('delete', 'forward', name, label, '',
+                                          self.unforwarder(name, int(existing['publicPort']))))
+        for change in creates:
+            change.deps += [delete.key for delete in deletes]
+        return deletes + creates
+
+    def cloudspace(self, name, refresh=False):
+        """Current cloudspace, refreshed when it got created and has no external ip yet."""
+        with self.lock:
+            cloudspace = self.cloudspaces[name]
+            if refresh and not cloudspace.get('externalnetworkip'):
+                listed = {cs['id']: cs for cs in self.client.api('cloudapi/cloudspaces/list', cached=False)}
+                cloudspace = self.cloudspaces[name] = listed.get(cloudspace['id'], cloudspace)
+            return cloudspace
+
+    def create_cloudspace(self, spec, account):
+        csid = self.client.create_cloudspace(spec['name'], account, spec['type'])
+        with self.lock:
+            self.cloudspaces[spec['name']] = {'id': csid, 'name': spec['name']}
+            self.vms[spec['name']] = {}
+
+    def creator(self, csname, spec):
+        def create():
+            cli = self.client
+            vm = cli.create_vm(self.cloudspace(csname), spec['name'], spec['memory'], spec['vcpus'],
+                               cli.get_image_id(spec['image']), cli.get_userdata())
+            with self.lock:
+                self.vms[csname][vm['name']] = vm
+        return create
+
+    def resizer(self, existing, spec):
+        return lambda: self.client.resize_vm(existing['id'], spec['memory'], spec['vcpus'])
+
+    def deleter(self, existing):
+        return lambda: self.client.delete_vm_by_id(existing['id'])
+
+    def forwarder(self, csname, vmname, forward):
+        def create():
+            with self.lock:
+                vm = self.vms[csname][vmname]
+            cloudspace = self.cloudspace(csname, refresh=True)
+            allocator = self.client.port_allocator(cloudspace)
+            for port in self.reserved.get(csname, ()):
+                allocator.mark_used(port)
+            return self.client.add_forward(cloudspace, vm, forward['local'], forward['public'])
+        return create
+
+    def unforwarder(self, csname, publicport):
+        return lambda: self.client.delete_forward(self.cloudspace(csname), publicport)
+
+
+def run_graph(changes, workers=8, report=None):
+    """
+    Run changes on a thread pool as soon as their dependencies succeeded
+
+    Changes depending on a failed change are skipped.
+
+    :param report: Callable taking a change and its error, None on success
+    :type report: callable, optional
+    :return: Error per change key, None for changes that succeeded
+    :rtype: dict
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+    keys = {change.key for change in changes}
+    pending = {change.key: change for change in changes}
+    deps = {change.key: {dep for dep in change.deps if dep in keys} for change in changes}
+    results = {}
+    running = {}
+
+    def done(change, error):
+        results[change.key] = error
+        if report:
+            report(change, error)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while pending or running:
+            scheduled = True
+            while scheduled:
+                scheduled = False
+                for key, change in list(pending.items()):
+                    if not deps[key] <= results.keys():
+                        continue
+                    del pending[key]
+                    scheduled = True
+                    failed = [dep for dep in deps[key] if results[dep] is not None]
+                    if failed:
+                        done(change, RuntimeError('skipped, {} failed'.format(failed[0])))
+                    else:
+                        running[pool.submit(change.func)] = change
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done(running.pop(future), future.exception())
+    return results
@@ -0,0 +1,139 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from .utils import fanout, jwt_claims
+
+TOKENPATH = os.path.expanduser('~/.config/ovcli/tokens.json')
+
+# Tokens expiring within this many seconds get refreshed ahead of time
+REFRESH_MARGIN = 300
+
+
+class TokenStore:
+    """JWT store per environment, kept apart from ovc.cfg.
+
+    The token file is only touched while holding a lock so parallel
+    invocations never overwrite each other's tokens. Decoded expiry times are
+    kept in memory. A token that is close to expiry is still handed out while
+    a fresh one is fetched in the background, only expired tokens block.
+
+    :param fetch: Callable taking an environment and returning a new jwt
+    :type fetch: callable
+    :param seed: Tokens to fall back on when the store has none (e.g. legacy jwt.* config keys)
+    :type seed: dict, optional
+    """
+
+    def __init__(self, fetch, seed=None, path=TOKENPATH, margin=REFRESH_MARGIN):
+        self.fetch = fetch
+        self.seed = seed or {}
+        self.path = path
+        self.margin = margin
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.refreshing = set()
+
+    @contextmanager
+    def locked(self, mode):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'a') as lockfd:
+            fcntl.flock(lockfd, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfd, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def _remember(self, environment, jwt):
+        try:
+            expires = jwt_claims(jwt)['exp']
+        except (ValueError, KeyError):
+            return None
+        with self.lock:
+            self.tokens[environment] = (jwt, expires)
+        return expires
+
+    def _cached(self, environment):
+        with self.lock:
+            return self.tokens.get(environment, (None, 0))
+
+    def _load(self, environment):
+        with self.locked(fcntl.LOCK_SH):
+            jwt = self._read().get(environment)
+        if not jwt:
+            jwt = self.seed.get(environment)
+        if jwt:
+            self._remember(environment, jwt)
+        return self._cached(environment)
+
+    def refresh(self, environment):
+        # another process might have refreshed already
+        with self.locked(fcntl.LOCK_SH):
+            jwt = self._read().get(environment)
+        if jwt and (self._remember(environment, jwt) or 0) - self.margin > time.time():
+            return jwt
+        # fetch without holding the lock so other environments and processes are not held up
+        jwt = self.fetch(environment)
+        expires = self._remember(environment, jwt) or 0
+        with self.locked(fcntl.LOCK_EX):
+            tokens = self._read()
+            current = tokens.get(environment)
+            if current and (self._remember(environment, current) or 0) > expires:
+                # a token fetched meanwhile outlives ours
+                return current
+            tokens[environment] = jwt
+            tmpname = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fd:
+                json.dump(tokens, fd)
+            os.replace(tmpname, self.path)
+        self._remember(environment, jwt)
+        return jwt
+
+    def _refresh_background(self, environment):
+        with self.lock:
+            if environment in self.refreshing:
+                return
+            self.refreshing.add(environment)
+
+        def run():
+            try:
+                self.refresh(environment)
+            except Exception:
+                pass
+            finally:
+                with self.lock:
+                    self.refreshing.discard(environment)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self, environment):
+        jwt, expires = self._cached(environment)
+        if not jwt or expires - self.margin < time.time():
+            jwt, expires = self._load(environment)
+        now = time.time()
+        if not jwt or expires < now:
+            return self.refresh(environment)
+        if expires - self.margin < now:
+            self._refresh_background(environment)
+        return jwt
+
+    def prefetch(self, environments, workers=8):
+        """Make sure every environment has a token that will not expire soon.
+
+        Tokens are fetched concurrently, returns the environments that failed.
+        """
+        def ensure(environment):
+            jwt, expires = self._load(environment)
+            if not jwt or expires - self.margin < time.time():
+                self.refresh(environment)
+
+        return [env for env, _, error in fanout(ensure, environments, workers) if error is not None]
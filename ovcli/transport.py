@@ -0,0 +1,142 @@
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .instrument import timed
+
+# (connect, read) timeouts in seconds, endpoints not listed use the default
+DEFAULT_TIMEOUT = (5, 30)
+TIMEOUTS = {
+    'cloudapi/cloudspaces/create': (5, 300),
+    'cloudapi/machines/create': (5, 300),
+    'cloudapi/machines/delete': (5, 120),
+    'cloudbroker/cloudspace/destroy': (5, 300),
+    'cloudbroker/zeroaccess/provision': (5, 60),
+}
+
+# Endpoints that only read state and can always be retried
+IDEMPOTENT = ('list', 'get', 'getNodes', 'whoami', 'access_token')
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+def parse_timeout(text):
+    connect, _, read = text.partition(',')
+    return float(connect), float(read or connect)
+
+
+def is_idempotent(url):
+    return urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1] in IDEMPOTENT
+
+
+class Transport:
+    """HTTP layer shared by all API calls.
+
+    Keeps one pooled keep-alive session per host, so environments on the same
+    host share connections. Calls get per-endpoint connect/read timeouts and
+    are retried with exponential backoff and jitter. Calls that change state
+    are only retried when the server cannot have acted on them: a failed
+    connect, 429 or 503.
+
+    :param pool_size: Connections kept per host, defaults to 16
+    :type pool_size: int, optional
+    :param retries: Amount of retries after the first attempt, defaults to 3
+    :type retries: int, optional
+    :param backoff: Base delay in seconds between retries, defaults to 0.5
+    :type backoff: float, optional
+    :param timeouts: Overrides of the (connect, read) timeout per endpoint, 'default' sets the default
+    :type timeouts: dict, optional
+    """
+
+    def __init__(self, pool_size=16, retries=3, backoff=0.5, timeouts=None):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeouts = {key.lower(): value for key, value in TIMEOUTS.items()}
+        self.timeouts.update({key.lower(): value for key, value in (timeouts or {}).items()})
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Create a transport from the [transport] and [timeouts] sections of ovc.cfg."""
+        options = config['transport'] if config.has_section('transport') else {}
+        timeouts = {}
+        if config.has_section('timeouts'):
+            timeouts = {key: parse_timeout(value) for key, value in config['timeouts'].items()}
+        return cls(pool_size=int(options.get('pool_size', 16)),
+                   retries=int(options.get('retries', 3)),
+                   backoff=float(options.get('backoff', 0.5)),
+                   timeouts=timeouts)
+
+    def _mount(self, session):
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                session = self.sessions[host] = requests.Session()
+                session.headers['Accept'] = 'application/json'
+                self._mount(session)
+            return session
+
+    def resize(self, pool_size):
+        with self.lock:
+            if pool_size <= self.pool_size:
+                return
+            self.pool_size = pool_size
+            for session in self.sessions.values():
+                self._mount(session)
+
+    def timeout(self, endpoint):
+        return self.timeouts.get(endpoint.lower(), self.timeouts.get('default', DEFAULT_TIMEOUT))
+
+    def delay(self, attempt, response=None):
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            return int(response.headers['Retry-After'])
+        return self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def _send(self, session, url, endpoint, environment, attempt, kwargs):
+        with timed('http', endpoint, environment=environment, attempt=attempt) as span:
+            response = session.post(url, **kwargs)
+            span['status'] = response.status_code
+            span['bytes'] = len(response.content)
+        return response
+
+    def post(self, url, endpoint=None, idempotent=None, environment=None, **kwargs):
+        if idempotent is None:
+            idempotent = is_idempotent(url)
+        if endpoint is None:
+            parts = urlsplit(url)
+            endpoint = parts.netloc + parts.path
+        kwargs.setdefault('timeout', self.timeout(endpoint))
+        session = self.session(url)
+        attempt = 0
+        while True:
+            try:
+                response = self._send(session, url, endpoint, environment, attempt, kwargs)
+            except requests.ConnectTimeout:
+                if attempt >= self.retries:
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or attempt >= self.retries:
+                    raise
+            else:
+                retry = response.status_code in RETRY_STATUSES
+                if not idempotent:
+                    retry = response.status_code in (429, 503)
+                if not retry or attempt >= self.retries:
+                    return response
+                time.sleep(self.delay(attempt, response))
+                attempt += 1
+                continue
+            time.sleep(self.delay(attempt))
+            attempt += 1
@@ -1,6 +1,14 @@
 import base64
-import os
-import subprocess
+import fnmatch
+import functools
+import json
+import re
+import shutil
+import sys
+import threading
+import time
+
+from .instrument import timed
 
 
 def base64url_decode(input):
@@ -16,32 +24,215 @@ def base64url_decode(input):
     return base64.urlsafe_b64decode(input)
 
 
+def jwt_claims(jwt):
+    """Decode the claims of a jwt without verifying its signature."""
+    jwt = jwt.encode('utf-8')
+    signing_input, _ = jwt.rsplit(b'.', 1)
+    _, claims_segment = signing_input.split(b'.', 1)
+    claimsdata = base64url_decode(claims_segment)
+    if isinstance(claimsdata, bytes):
+        claimsdata = claimsdata.decode('utf-8')
+    return json.loads(claimsdata)
+
+
+def is_pattern(match, mode='substring'):
+    """Whether match selects several items, glob characters only count in the substring and prefix modes."""
+    return match == 'all' or mode in GLOB_MODES and any(char in match for char in '*?[')
+
+
+def match_items(items, pattern):
+    if pattern == 'all':
+        return list(sorted(items))
+    return list(sorted(fnmatch.filter(items, pattern)))
+
+
+# Keeps lines printed by worker threads from interleaving
+OUTPUT_LOCK = threading.Lock()
+
+
+def print_line(line):
+    """Write a whole line to stdout, safe to call from several threads."""
+    with OUTPUT_LOCK:
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+
+def fanout(func, items, workers=8):
+    """Call func for every item on a bounded thread pool.
+
+    Returns a list of (item, result, error) tuples in the order of items,
+    so one failing item does not hide the results of the others.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def call(item):
+        try:
+            return item, func(item), None
+        except Exception as error:
+            return item, None, error
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(call, items))
+
+
+MATCH_MODES = ['substring', 'exact', 'prefix', 'regex', 'fuzzy']
+# Match modes in which *, ? and [ make a glob pattern
+GLOB_MODES = ['substring', 'prefix']
+PAGE_SIZE = 50
+
+
+@functools.lru_cache(maxsize=None)
+def has_fzf():
+    return shutil.which('fzf') is not None
+
+
+def fuzzy_score(query, item):
+    """Score how well query matches item as a subsequence, None when it does not.
+
+    Consecutive characters and characters at the start of a word score higher,
+    so 'wrk1' ranks 'worker-1' above 'web-rack-17'.
+    """
+    query = query.lower()
+    text = item.lower()
+    score = 0
+    position = 0
+    previous = -2
+    for char in query:
+        position = text.find(char, position)
+        if position == -1:
+            return None
+        if position == previous + 1:
+            score += 3
+        if position == 0 or not text[position - 1].isalnum():
+            score += 2
+        score -= position - previous - 1 if previous >= 0 else position
+        previous = position
+        position += 1
+    return score
+
+
+class FuzzyMatcher:
+    """Ranks items against a query.
+
+    While the query only grows (as it does when typing) the previous matches
+    are narrowed down instead of scanning all items again.
+    """
+
+    def __init__(self, items):
+        self.items = list(items)
+        self.query = ''
+        self.matches = self.items
+
+    def match(self, query):
+        candidates = self.matches if self.query and query.startswith(self.query) else self.items
+        scored = [(fuzzy_score(query, item), item) for item in candidates]
+        self.matches = [item for score, item in sorted((entry for entry in scored if entry[0] is not None),
+                                                       key=lambda entry: (-entry[0], len(entry[1]), entry[1]))]
+        self.query = query
+        return self.matches
+
+
+def filter_items(items, match, mode='substring'):
+    if mode == 'exact':
+        return [item for item in items if item == match]
+    elif mode == 'prefix':
+        return [item for item in items if item.startswith(match)]
+    elif mode == 'regex':
+        regex = re.compile(match)
+        return [item for item in items if regex.search(item)]
+    elif mode == 'fuzzy':
+        return FuzzyMatcher(items).match(match)
+    return [item for item in items if match in item]
+
+
+class RateLimiter:
+    """Spread calls out to at most rate calls per second over all threads."""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next)
+            self.next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
 def select_item_fzf(items, prompt):
-    proc = subprocess.Popen(['fzf', '--prompt', prompt], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    proc.stdin.write(('\n'.join(items)).encode('utf-8'))
-    proc.stdin.close()
-    proc.wait()
-    return proc.stdout.read().strip().decode('utf-8')
-
-def select_item(items, prompt, match=None):
-    items = list(sorted(items))
+    import subprocess
+    with timed('fzf', 'fzf', items=len(items)):
+        proc = subprocess.Popen(['fzf', '--prompt', prompt], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        proc.stdin.write(('\n'.join(items)).encode('utf-8'))
+        proc.stdin.close()
+        proc.wait()
+        return proc.stdout.read().strip().decode('utf-8')
+
+
+def select_item_prompt(items, prompt):
+    from prompt_toolkit import prompt as ptprompt
+    from prompt_toolkit.completion import Completer, Completion
+    from prompt_toolkit.validation import Validator
+
+    matcher = FuzzyMatcher(items)
+    known = set(items)
+
+    class FuzzyCompleter(Completer):
+        def get_completions(self, document, complete_event):
+            text = document.text_before_cursor
+            matches = matcher.match(text) if text else items
+            for item in matches[:PAGE_SIZE]:
+                yield Completion(item, -len(text))
+
+    validator = Validator.from_callable(lambda text: text in known, error_message='Select an item from the list')
+    return ptprompt(prompt, completer=FuzzyCompleter(), complete_while_typing=True, validator=validator)
+
+
+def select_item_paged(items, prompt):
+    matcher = FuzzyMatcher(items)
+    matches = items
+    page = 0
+    while True:
+        offset = page * PAGE_SIZE
+        for idx, item in enumerate(matches[offset:offset + PAGE_SIZE], offset + 1):
+            print("{}: {}".format(idx, item))
+        if len(matches) > offset + PAGE_SIZE:
+            print("-- {} more, enter 'n' for the next page or text to filter --".format(len(matches) - offset - PAGE_SIZE))
+        data = input(prompt)
+        if data.isdigit():
+            idx = int(data) - 1
+            if idx < len(matches):
+                return matches[idx]
+            print('Entered wrong value')
+        elif data == 'n' and len(matches) > offset + PAGE_SIZE:
+            page += 1
+        else:
+            filtered = matcher.match(data) if data else items
+            if len(filtered) == 1:
+                return filtered[0]
+            if not filtered:
+                print('Nothing matches {}'.format(data))
+                continue
+            matches = filtered
+            page = 0
+
+
+def select_item(items, prompt, match=None, mode='substring'):
     if match:
-        items = list(filter(lambda item: match in item, items))
+        items = filter_items(items, match, mode)
         if len(items) == 0:
             raise LookupError('Could not find item with filter {}'.format(match))
+    if mode != 'fuzzy' or not match:
+        items = list(sorted(items))
     if len(items) == 1:
         return items[0]
-    try:
-        subprocess.check_call(['which', 'fzf'], stdout=open(os.devnull))
-    except subprocess.CalledProcessError:
-        while True:
-            for idx, item in enumerate(items):
-                print("{}: {}".format(idx + 1, item))
-            data = input(prompt)
-            if data.isdigit():
-                idx = int(data) - 1
-                if idx < len(items):
-                    return items[idx]
-            print('Entered wrong value')
-    else:
+    if has_fzf():
         return select_item_fzf(items, prompt)
+    if sys.stdin.isatty() and sys.stdout.isatty():
+        return select_item_prompt(items, prompt)
+    return select_item_paged(items, prompt)
@@ -0,0 +1,92 @@
+import json
+import sys
+import time
+
+
+def diff(previous, current):
+    """Compare two {key: record} mappings and return change events."""
+    events = []
+    for key, record in current.items():
+        old = previous.get(key)
+        if old is None:
+            events.append({'event': 'added', 'key': key, 'record': record})
+        elif old != record:
+            changes = {field: [old.get(field), record.get(field)]
+                       for field in set(old) | set(record) if old.get(field) != record.get(field)}
+            events.append({'event': 'changed', 'key': key, 'record': record, 'changes': changes})
+    for key, record in previous.items():
+        if key not in current:
+            events.append({'event': 'removed', 'key': key, 'record': record})
+    return events
+
+
+class Watcher:
+    """Poll a listing and emit only what changed.
+
+    The poll interval drops back to ``interval`` as soon as something changes
+    and doubles (up to ``max_interval``) every poll that nothing changes or
+    that fails. A failing poll is emitted as an ``error`` event and the
+    records of the last good poll are kept.
+
+    :param fetch: Callable returning the current list of records
+    :type fetch: callable
+    :param key: Callable returning the identity of a record
+    :type key: callable
+    """
+
+    def __init__(self, fetch, key, interval=2, max_interval=60):
+        self.fetch = fetch
+        self.key = key
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.records = {}
+
+    def poll(self):
+        current = {self.key(record): record for record in self.fetch()}
+        events = diff(self.records, current)
+        self.records = current
+        return events
+
+    def run(self, emit):
+        delay = self.interval
+        while True:
+            try:
+                events = self.poll()
+            except Exception as error:
+                emit([{'event': 'error', 'error': str(error) or type(error).__name__}])
+                events = None
+            if events:
+                emit(events)
+                delay = self.interval
+            else:
+                delay = min(delay * 2, self.max_interval)
+            time.sleep(delay)
+
+
+def ndjson_emitter(environment, kind):
+    def emit(events):
+        now = time.time()
+        for event in events:
+            event = dict(event, time=now, environment=environment, kind=kind)
+            sys.stdout.write(json.dumps(event) + '\n')
+        sys.stdout.flush()
+    return emit
+
+
+def text_emitter(formatter):
+    signs = {'added': '+', 'removed': '-', 'changed': '~'}
+
+    def emit(events):
+        lines = []
+        for event in events:
+            if event['event'] == 'error':
+                lines.append('! {}'.format(event['error']))
+                continue
+            line = '{} {}'.format(signs[event['event']], formatter(event['record']))
+            if event['event'] == 'changed':
+                line += ' ({})'.format(', '.join('{}: {} -> {}'.format(field, old, new)
+                                                 for field, (old, new) in sorted(event['changes'].items())))
+            lines.append(line)
+        sys.stdout.write(time.strftime('%H:%M:%S') + '\n' + '\n'.join(lines) + '\n')
+        sys.stdout.flush()
+    return emit
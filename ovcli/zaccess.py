@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+
+from .cache import CACHEDIR
+
+# Seconds a provisioning result is trusted when the API does not say when it expires
+DEFAULT_TTL = 600
+
+# Provisionings expiring within this many seconds are redone
+EXPIRY_MARGIN = 60
+
+# Seconds an idle ControlMaster connection stays open
+CONTROL_PERSIST = 600
+
+SOCKETDIR = os.path.join(CACHEDIR, 'ssh')
+
+
+def node_ip(node):
+    """Backplane ip of a node, falls back on its first ip address."""
+    for nic in node.get('netaddr', []):
+        if nic['name'] == 'backplane1':
+            for ip in nic['ip']:
+                return ip
+    return node['ipaddr'][0]
+
+
+class ProvisionCache:
+    """Zero-access provisioning results per environment and node ip.
+
+    Results are kept in ``<environment>/zeroaccess.json`` next to the response
+    cache and reused until they expire, so reconnecting to a node does not
+    provision it again.
+
+    :param ttl: Seconds a result without an expiration stays valid, defaults to 600
+    :type ttl: int, optional
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, path=CACHEDIR, margin=EXPIRY_MARGIN):
+        self.ttl = ttl
+        self.path = path
+        self.margin = margin
+        self.lock = threading.Lock()
+
+    def _filename(self, environment):
+        return os.path.join(self.path, environment, 'zeroaccess.json')
+
+    def _read(self, environment):
+        try:
+            with open(self._filename(environment)) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, environment, entries):
+        filename = self._filename(environment)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmpname = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fd:
+            json.dump(entries, fd)
+        os.replace(tmpname, filename)
+
+    def get(self, environment, remote):
+        entry = self._read(environment).get(remote)
+        if not entry or entry['expires'] - self.margin < time.time():
+            return None
+        return entry['result']
+
+    def put(self, environment, remote, result):
+        expires = result.get('expiration') or time.time() + self.ttl
+        with self.lock:
+            now = time.time()
+            entries = {key: value for key, value in self._read(environment).items() if value['expires'] > now}
+            entries[remote] = {'result': result, 'expires': expires}
+            self._write(environment, entries)
+
+    def invalidate(self, environment, remote):
+        with self.lock:
+            entries = self._read(environment)
+            if entries.pop(remote, None) is not None:
+                self._write(environment, entries)
+
+
+def ssh_options(persist=CONTROL_PERSIST, socketdir=SOCKETDIR):
+    """Options sharing one ControlMaster connection per user, host and port.
+
+    %C is a hash of the connection, which keeps the socket path short enough
+    for a unix socket.
+    """
+    os.makedirs(socketdir, mode=0o700, exist_ok=True)
+    return ['-o', 'ControlMaster=auto', '-o', 'ControlPath={}'.format(os.path.join(socketdir, '%C')),
+            '-o', 'ControlPersist={}'.format(persist)]
+
+
+def ssh_command(result, forward=True, persist=CONTROL_PERSIST, args=(), batch=False):
+    """
+    Build the ssh command for a provisioning result
+
+    :param result: Result of cloudbroker/zeroaccess/provision
+    :type result: dict
+    :param forward: Forward the ssh agent, defaults to True
+    :type forward: bool, optional
+    :param persist: Seconds the master connection stays open, 0 disables multiplexing
+    :type persist: int, optional
+    :param args: Extra arguments like a remote command
+    :type args: list, optional
+    :param batch: Never prompt for passwords or host keys, defaults to False
+    :type batch: bool, optional
+    """
+    cmd = ['ssh', '-p', str(result['ssh_port'])]
+    if forward:
+        cmd.append('-A')
+    if batch:
+        cmd += ['-o', 'BatchMode=yes']
+    if persist:
+        cmd += ssh_options(persist)
+    return cmd + ['{username}@{ssh_ip}'.format(**result)] + list(args)
+
+
+def run_remote(cmd, emit, timeout=None):
+    """
+    Run an ssh command and pass every output line to emit as it arrives
+
+    :param cmd: Full ssh command
+    :type cmd: list
+    :param emit: Callable taking a stream name ('stdout' or 'stderr') and a line
+    :type emit: callable
+    :param timeout: Seconds after which the command is killed
+    :type timeout: float, optional
+    :return: Exit code, stdout and stderr lines and duration
+    :rtype: dict
+    """
+    import subprocess
+    start = time.time()
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, errors='replace')
+    lines = {'stdout': [], 'stderr': []}
+
+    def pump(name, stream):
+        for line in stream:
+            line = line.rstrip('\n')
+            lines[name].append(line)
+            emit(name, line)
+
+    readers = [threading.Thread(target=pump, args=item, daemon=True)
+               for item in (('stdout', proc.stdout), ('stderr', proc.stderr))]
+    for reader in readers:
+        reader.start()
+    timedout = False
+    try:
+        proc.wait(timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+        timedout = True
+    duration = time.time() - start
+    # a ControlPersist master started by this ssh keeps its pipes open, so do
+    # not wait for end of file once the command itself exited
+    deadline = time.time() + 1
+    for reader in readers:
+        reader.join(max(0, deadline - time.time()))
+    return {'exitcode': proc.returncode, 'timeout': timedout, 'stdout': list(lines['stdout']),
+            'stderr': list(lines['stderr']), 'duration': duration}